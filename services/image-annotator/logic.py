@@ -2,15 +2,27 @@ import json
 import os
 import uuid
 import threading
+import zlib
+from collections import OrderedDict
 from datetime import datetime, timezone
 
 from PIL import Image, ImageDraw, ImageFont
 
 EXCHANGE = 'imageanalyzer.events'
 IMAGES_DIR = '/data/images'
+ANNOTATOR_PARTITIONS = 16
+UNSHARDED_QUEUES = {
+    'annotator-metadata': 'image.metadata_extracted.#',
+    'annotator-detections': 'image.objects_detected.#',
+}
+JOINED_MEMORY = 10000
+JOIN_KEYS = {
+    'image.metadata_extracted': ('metadata', {}),
+    'image.objects_detected': ('detections', []),
+}
 
 
-def record_event(neo4j_driver, event, prev_event_types):
+def record_event(neo4j_driver, event, prev_event_ids):
     with neo4j_driver.session() as session:
         session.run(
             "MERGE (w:Workflow {id: $wid}) "
@@ -19,12 +31,12 @@ def record_event(neo4j_driver, event, prev_event_types):
             wid=event['workflowId'], eid=event['eventId'],
             type=event['eventType'], ts=event['timestamp']
         )
-        for prev_type in prev_event_types:
+        for prev_id in prev_event_ids:
             session.run(
-                "MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType}) "
+                "MATCH (prev:Event {id: $prevId}) "
                 "MATCH (cur:Event {id: $curId}) "
-                "CREATE (prev)-[:TRIGGERS]->(cur)",
-                wid=event['workflowId'], prevType=prev_type, curId=event['eventId']
+                "MERGE (prev)-[:TRIGGERS]->(cur)",
+                prevId=prev_id, curId=event['eventId']
             )
 
 
@@ -47,7 +59,7 @@ def draw_text_with_bg(draw, xy, text, font, fill=(255, 255, 255), bg=(0, 0, 0, 1
     draw.text(xy, text, font=font, fill=fill)
 
 
-def annotate(workflow_id, metadata, detections, filename, images_dir=None):
+def annotate(workflow_id, metadata, detections, filename, images_dir=None, out_dir=None):
     if images_dir is None:
         images_dir = IMAGES_DIR
     filepath = os.path.join(images_dir, filename)
@@ -85,19 +97,45 @@ def annotate(workflow_id, metadata, detections, filename, images_dir=None):
 
     img = Image.alpha_composite(img, overlay).convert('RGB')
     out_filename = f"{workflow_id}_annotated.jpg"
-    out_path = os.path.join(images_dir, out_filename)
+    out_path = os.path.join(out_dir or images_dir, out_filename)
     img.save(out_path, 'JPEG', quality=92)
     return out_filename
 
 
-def update_state(state, state_lock, workflow_id, key, value, filename):
+def update_state(state, state_lock, workflow_id, key, value, filename, event=None):
     with state_lock:
         state.setdefault(workflow_id, {})
         state[workflow_id][key] = value
         state[workflow_id].setdefault('filename', filename)
+        if event is not None:
+            state[workflow_id].setdefault('events', {})[key] = event
+            causes = state[workflow_id].setdefault('causes', {})
+            causes[key] = event.get('eventId')
+            state[workflow_id].setdefault('correlationId', event.get('correlationId', workflow_id))
 
 
-def try_annotate(ch, workflow_id, state, state_lock, neo4j_driver, images_dir=None):
+def new_joined():
+    return OrderedDict()
+
+
+def already_joined(joined, state_lock, event):
+    # Upstream republishes a redelivered event with the same eventId; once its join is done,
+    # taking it again would leave a half-join that never completes, or render twice.
+    if joined is None or not event.get('eventId'):
+        return False
+    with state_lock:
+        return event['eventId'] in joined
+
+
+def remember_joined(joined, causes, max_entries=JOINED_MEMORY):
+    for event_id in causes:
+        joined[event_id] = True
+        joined.move_to_end(event_id)
+    while len(joined) > max_entries:
+        joined.popitem(last=False)
+
+
+def try_annotate(ch, workflow_id, state, state_lock, neo4j_driver, images_dir=None, joined=None):
     with state_lock:
         entry = state.get(workflow_id, {})
         if 'metadata' not in entry or 'detections' not in entry:
@@ -105,7 +143,11 @@ def try_annotate(ch, workflow_id, state, state_lock, neo4j_driver, images_dir=No
         metadata = entry['metadata']
         detections = entry['detections']
         filename = entry['filename']
+        causes = [eid for eid in entry.get('causes', {}).values() if eid]
+        correlation_id = entry.get('correlationId', workflow_id)
         del state[workflow_id]
+        if joined is not None:
+            remember_joined(joined, causes)
 
     out_filename = annotate(workflow_id, metadata, detections, filename, images_dir)
     if not out_filename:
@@ -115,28 +157,130 @@ def try_annotate(ch, workflow_id, state, state_lock, neo4j_driver, images_dir=No
         'eventId': str(uuid.uuid4()),
         'eventType': 'image.annotated',
         'workflowId': workflow_id,
+        'causationId': causes[-1] if causes else None,
+        'correlationId': correlation_id,
         'timestamp': datetime.now(timezone.utc).isoformat(),
         'payload': {'filename': out_filename},
     }
     ch.basic_publish(exchange=EXCHANGE, routing_key='image.annotated',
                      body=json.dumps(out_event))
-    record_event(neo4j_driver, out_event, ['image.metadata_extracted', 'image.objects_detected'])
+    record_event(neo4j_driver, out_event, causes)
     return out_event
 
 
-def on_metadata(ch, method, body, state, state_lock, neo4j_driver, images_dir=None):
+def on_metadata(ch, method, body, state, state_lock, neo4j_driver, images_dir=None, joined=None):
     event = json.loads(body)
     wid = event['workflowId']
-    update_state(state, state_lock, wid, 'metadata', event['payload'].get('metadata', {}), event['payload']['filename'])
-    result = try_annotate(ch, wid, state, state_lock, neo4j_driver, images_dir)
+    if already_joined(joined, state_lock, event):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return None
+    update_state(state, state_lock, wid, 'metadata', event['payload'].get('metadata', {}),
+                 event['payload']['filename'], event)
+    result = try_annotate(ch, wid, state, state_lock, neo4j_driver, images_dir, joined)
     ch.basic_ack(delivery_tag=method.delivery_tag)
     return result
 
 
-def on_detections(ch, method, body, state, state_lock, neo4j_driver, images_dir=None):
+def on_detections(ch, method, body, state, state_lock, neo4j_driver, images_dir=None, joined=None):
+    event = json.loads(body)
+    wid = event['workflowId']
+    if already_joined(joined, state_lock, event):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return None
+    update_state(state, state_lock, wid, 'detections', event['payload'].get('detections', []),
+                 event['payload']['filename'], event)
+    result = try_annotate(ch, wid, state, state_lock, neo4j_driver, images_dir, joined)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+    return result
+
+
+def annotator_partition(workflow_id):
+    return zlib.crc32(workflow_id.encode()) % ANNOTATOR_PARTITIONS
+
+
+def owned_partitions(shard_index, shard_count):
+    return {p for p in range(ANNOTATOR_PARTITIONS) if p % shard_count == shard_index}
+
+
+def partition_routing_keys(partitions):
+    return [f'{event_type}.{p}' for p in sorted(partitions) for event_type in JOIN_KEYS]
+
+
+def shard_queue(shard_index):
+    return f'annotator-shard-{shard_index}'
+
+
+def bind_shard_topology(ch, shard_count, existing_queues):
+    # Bind every partition to its owner's queue before unbinding it anywhere else, so no
+    # partition is ever left without a queue while shards restart one by one.
+    owners = {p: shard_queue(p % shard_count) for p in range(ANNOTATOR_PARTITIONS)}
+    for index in range(shard_count):
+        ch.queue_declare(queue=shard_queue(index), durable=True)
+    for p, owner in owners.items():
+        for routing_key in partition_routing_keys({p}):
+            ch.queue_bind(queue=owner, exchange=EXCHANGE, routing_key=routing_key)
+    for queue in existing_queues:
+        released = {p for p, owner in owners.items() if owner != queue}
+        for routing_key in partition_routing_keys(released):
+            ch.queue_unbind(queue=queue, exchange=EXCHANGE, routing_key=routing_key)
+
+
+def release_unsharded_queues(ch, existing_queues):
+    # Switching from unsharded to sharded mode: once the shard queues are bound, stop the
+    # catch-all queues from getting a copy of every event. Returns the queues left to drain.
+    released = [queue for queue in UNSHARDED_QUEUES if queue in existing_queues]
+    for queue in released:
+        ch.queue_unbind(queue=queue, exchange=EXCHANGE, routing_key=UNSHARDED_QUEUES[queue])
+    return released
+
+
+def forward_event(ch, event, via=None):
+    routing_key = f"{event['eventType']}.{annotator_partition(event['workflowId'])}"
+    if via is not None:
+        event = {**event, 'forwardedBy': via}
+    ch.basic_publish(exchange=EXCHANGE, routing_key=routing_key, body=json.dumps(event))
+
+
+def handoff_pending(ch, state, state_lock, keep=None, via=None):
+    # Re-route half-joined workflows so whichever shard owns them now can finish the join.
+    with state_lock:
+        wids = [wid for wid in state if keep is None or not keep(wid)]
+        entries = [state.pop(wid) for wid in wids]
+    for entry in entries:
+        for event in entry.get('events', {}).values():
+            forward_event(ch, event, via)
+    return wids
+
+
+def on_sharded_event(ch, method, body, state, state_lock, neo4j_driver, partitions, images_dir=None,
+                     queue=None, joined=None):
     event = json.loads(body)
     wid = event['workflowId']
-    update_state(state, state_lock, wid, 'detections', event['payload'].get('detections', []), event['payload']['filename'])
-    result = try_annotate(ch, wid, state, state_lock, neo4j_driver, images_dir)
+    # Something we forwarded came back: a shard running with a newer count routes this
+    # partition to our queue now, so both halves of the join arrive here.
+    routed_back = queue is not None and event.get('forwardedBy') == queue
+    if annotator_partition(wid) not in partitions and not routed_back:
+        # Left in our queue from before a reshard: pass it on to the current owner.
+        forward_event(ch, event, queue)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return None
+    if already_joined(joined, state_lock, event):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return None
+    key, default = JOIN_KEYS[event['eventType']]
+    update_state(state, state_lock, wid, key, event['payload'].get(key, default),
+                 event['payload']['filename'], event)
+    result = try_annotate(ch, wid, state, state_lock, neo4j_driver, images_dir, joined)
     ch.basic_ack(delivery_tag=method.delivery_tag)
     return result
+
+
+def describe_message(body, result):
+    event = json.loads(body)
+    payload = event.get('payload', {})
+    return {
+        'eventType': event.get('eventType'),
+        'detections': len(payload.get('detections', [])),
+        'exifTags': len(payload.get('metadata', {}).get('exif', {})),
+        'joined': result is not None,
+    }
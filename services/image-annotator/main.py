@@ -1,10 +1,18 @@
 import os
+import signal
 import threading
 
 import pika
 from neo4j import GraphDatabase
 
-from logic import EXCHANGE, on_metadata, on_detections
+import logic
+from logic import (
+    EXCHANGE, ANNOTATOR_PARTITIONS, on_metadata, on_detections, on_sharded_event, describe_message,
+    owned_partitions, handoff_pending, shard_queue, bind_shard_topology, release_unsharded_queues,
+    UNSHARDED_QUEUES, new_joined,
+)
+from profiling import setup_profiling
+from tracing import setup_tracing
 
 neo4j_driver = GraphDatabase.driver(
     os.environ['NEO4J_URI'],
@@ -13,14 +21,94 @@ neo4j_driver = GraphDatabase.driver(
 
 state = {}
 state_lock = threading.Lock()
+joined = new_joined()
+
+profiler = setup_profiling(logic, ['annotate', 'record_event'], describe_message)
+tracer = setup_tracing('image-annotator', pika.BasicProperties)
+
+SHARD_COUNT = int(os.environ.get('ANNOTATOR_SHARD_COUNT', '0'))
+SHARD_INDEX = int(os.environ.get('ANNOTATOR_SHARD_INDEX', '0'))
 
 
 def _on_metadata(ch, method, properties, body):
-    on_metadata(ch, method, body, state, state_lock, neo4j_driver)
+    with tracer.consume(ch, properties, body) as traced_ch:
+        return on_metadata(traced_ch, method, body, state, state_lock, neo4j_driver, joined=joined)
 
 
 def _on_detections(ch, method, properties, body):
-    on_detections(ch, method, body, state, state_lock, neo4j_driver)
+    with tracer.consume(ch, properties, body) as traced_ch:
+        return on_detections(traced_ch, method, body, state, state_lock, neo4j_driver, joined=joined)
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def setup_unsharded(channel):
+    for queue, routing_key in UNSHARDED_QUEUES.items():
+        channel.queue_declare(queue=queue, durable=True)
+        channel.queue_bind(queue=queue, exchange=EXCHANGE, routing_key=routing_key)
+
+    channel.basic_consume(queue='annotator-metadata', on_message_callback=profiler.wrap(_on_metadata))
+    channel.basic_consume(queue='annotator-detections', on_message_callback=profiler.wrap(_on_detections))
+
+
+def existing_queues(connection, names):
+    # A passive declare of a missing queue closes the channel, so probe on a throwaway one.
+    queues = []
+    probe = connection.channel()
+    for name in names:
+        try:
+            probe.queue_declare(queue=name, passive=True)
+            queues.append(name)
+        except pika.exceptions.ChannelClosedByBroker:
+            probe = connection.channel()
+    probe.close()
+    return queues
+
+
+def setup_sharded(connection, channel):
+    queue = shard_queue(SHARD_INDEX)
+    partitions = owned_partitions(SHARD_INDEX, SHARD_COUNT)
+    channel.queue_declare(queue=queue, durable=True)
+    shard_queues = existing_queues(connection, [shard_queue(i) for i in range(ANNOTATOR_PARTITIONS)])
+    bind_shard_topology(channel, SHARD_COUNT, shard_queues)
+    for legacy in release_unsharded_queues(channel, existing_queues(connection, UNSHARDED_QUEUES)):
+        drain_queue(connection, channel, legacy)
+
+    if not partitions:
+        drain_queue(connection, channel, queue)
+        return False
+
+    def _on_event(ch, method, properties, body):
+        with tracer.consume(ch, properties, body) as traced_ch:
+            return on_sharded_event(traced_ch, method, body, state, state_lock, neo4j_driver, partitions,
+                                    queue=queue, joined=joined)
+
+    channel.basic_consume(queue=queue, on_message_callback=profiler.wrap(_on_event))
+    print(f'Shard {SHARD_INDEX}/{SHARD_COUNT} owns partitions {sorted(partitions)}')
+    return True
+
+
+def drain_queue(connection, channel, queue):
+    # The queue is unbound (a retired shard, or the unsharded queues after switching to
+    # sharding), so forward what is left to the owning shards and remove it.
+    forwarded = 0
+    for method, properties, body in channel.consume(queue, inactivity_timeout=5):
+        if method is None:
+            break
+        on_sharded_event(channel, method, body, state, state_lock, neo4j_driver, set(), queue=queue)
+        forwarded += 1
+    channel.cancel()
+    # if_unused: never delete under a replica still consuming it, that would drop its unacked
+    # messages. The next shard to start tries again.
+    probe = connection.channel()
+    try:
+        probe.queue_delete(queue=queue, if_empty=True, if_unused=True)
+        probe.close()
+        print(f'Retired {queue}, forwarded {forwarded} messages')
+    except pika.exceptions.ChannelClosedByBroker:
+        print(f'Forwarded {forwarded} messages from {queue}; not deleted while still in use')
 
 
 def main():
@@ -29,17 +117,24 @@ def main():
     channel = connection.channel()
     channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic', durable=True)
 
-    channel.queue_declare(queue='annotator-metadata', durable=True)
-    channel.queue_bind(queue='annotator-metadata', exchange=EXCHANGE, routing_key='image.metadata_extracted')
-
-    channel.queue_declare(queue='annotator-detections', durable=True)
-    channel.queue_bind(queue='annotator-detections', exchange=EXCHANGE, routing_key='image.objects_detected')
-
-    channel.basic_consume(queue='annotator-metadata', on_message_callback=_on_metadata)
-    channel.basic_consume(queue='annotator-detections', on_message_callback=_on_detections)
+    if SHARD_COUNT:
+        if not setup_sharded(connection, channel):
+            connection.close()
+            return
+    else:
+        setup_unsharded(channel)
 
+    signal.signal(signal.SIGTERM, _raise_interrupt)
     print('Image Annotator waiting for messages...')
-    channel.start_consuming()
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        channel.stop_consuming()
+    finally:
+        handed_off = handoff_pending(channel, state, state_lock,
+                                     via=shard_queue(SHARD_INDEX) if SHARD_COUNT else None)
+        print(f'Handed off {len(handed_off)} pending joins')
+        connection.close()
 
 
 if __name__ == '__main__':
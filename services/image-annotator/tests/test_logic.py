@@ -5,7 +5,9 @@ from PIL import Image
 
 from logic import (
     annotate, update_state, try_annotate, on_metadata, on_detections,
-    load_font, draw_text_with_bg, record_event,
+    load_font, draw_text_with_bg, record_event, annotator_partition, owned_partitions,
+    partition_routing_keys, handoff_pending, on_sharded_event, describe_message, ANNOTATOR_PARTITIONS,
+    shard_queue, bind_shard_topology, new_joined, remember_joined, release_unsharded_queues, UNSHARDED_QUEUES, EXCHANGE,
 )
 
 
@@ -26,6 +28,14 @@ class TestAnnotate:
         assert result == 'wf-1_annotated.jpg'
         assert (tmp_path / 'wf-1_annotated.jpg').exists()
 
+    def test_writes_to_out_dir(self, tmp_path):
+        _create_test_image(tmp_path, 'wf-1.jpg')
+        out_dir = tmp_path / 'out'
+        out_dir.mkdir()
+        result = annotate('wf-1', {}, [], 'wf-1.jpg', images_dir=str(tmp_path), out_dir=str(out_dir))
+        assert (out_dir / result).exists()
+        assert not (tmp_path / result).exists()
+
     def test_draws_no_exif_label(self, tmp_path):
         _create_test_image(tmp_path, 'wf-1.jpg')
         result = annotate('wf-1', {}, [], 'wf-1.jpg', images_dir=str(tmp_path))
@@ -170,6 +180,53 @@ class TestOnDetections:
         assert result is not None
         assert result['eventType'] == 'image.annotated'
 
+    def test_redelivery_after_join_leaves_no_half_entry(self, tmp_path):
+        _create_test_image(tmp_path, 'wf-1.jpg')
+        state = {}
+        lock = threading.Lock()
+        joined = new_joined()
+        ch = MagicMock()
+        driver = MagicMock()
+        meta_body = json.dumps({'eventId': 'e-meta', 'workflowId': 'wf-1',
+                                'payload': {'filename': 'wf-1.jpg', 'metadata': {'exif': {}}}}).encode()
+        det_body = json.dumps({'eventId': 'e-det', 'workflowId': 'wf-1',
+                               'payload': {'filename': 'wf-1.jpg', 'detections': []}}).encode()
+
+        on_metadata(ch, MagicMock(), meta_body, state, lock, driver, images_dir=str(tmp_path), joined=joined)
+        on_detections(ch, MagicMock(), det_body, state, lock, driver, images_dir=str(tmp_path), joined=joined)
+        assert on_metadata(ch, MagicMock(), meta_body, state, lock, driver, images_dir=str(tmp_path),
+                           joined=joined) is None
+        assert state == {}
+        assert ch.basic_ack.call_count == 3
+
+    def test_join_links_both_parent_events(self, tmp_path):
+        _create_test_image(tmp_path, 'wf-1.jpg')
+        state = {}
+        lock = threading.Lock()
+        ch = MagicMock()
+        method = MagicMock()
+
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+
+        meta_body = json.dumps({
+            'eventId': 'e-meta', 'workflowId': 'wf-1', 'correlationId': 'corr-1',
+            'payload': {'filename': 'wf-1.jpg', 'metadata': {'exif': {}}},
+        }).encode()
+        det_body = json.dumps({
+            'eventId': 'e-det', 'workflowId': 'wf-1', 'correlationId': 'corr-1',
+            'payload': {'filename': 'wf-1.jpg', 'detections': []},
+        }).encode()
+        on_metadata(ch, method, meta_body, state, lock, driver, images_dir=str(tmp_path))
+        result = on_detections(ch, method, det_body, state, lock, driver, images_dir=str(tmp_path))
+
+        assert result['causationId'] == 'e-det'
+        assert result['correlationId'] == 'corr-1'
+        prev_ids = [c[1]['prevId'] for c in session.run.call_args_list[1:]]
+        assert prev_ids == ['e-meta', 'e-det']
+
 
 class TestLoadFont:
     def test_returns_font(self):
@@ -185,5 +242,219 @@ class TestRecordEvent:
         driver.session.return_value.__exit__ = MagicMock(return_value=False)
 
         event = {'workflowId': 'wf-1', 'eventId': 'e-1', 'eventType': 'image.annotated', 'timestamp': 't'}
-        record_event(driver, event, ['image.metadata_extracted', 'image.objects_detected'])
+        record_event(driver, event, ['e-meta', 'e-det'])
         assert session.run.call_count == 3  # 1 create + 2 triggers
+        prev_ids = [c[1]['prevId'] for c in session.run.call_args_list[1:]]
+        assert prev_ids == ['e-meta', 'e-det']
+
+
+class TestSharding:
+    def _driver(self):
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+        return driver
+
+    def _body(self, event_type, wid='wf-1', event_id='e-1'):
+        key = 'metadata' if event_type == 'image.metadata_extracted' else 'detections'
+        return json.dumps({
+            'eventId': event_id, 'eventType': event_type, 'workflowId': wid,
+            'payload': {'filename': f'{wid}.jpg', key: {'exif': {}} if key == 'metadata' else []},
+        }).encode()
+
+    def test_partition_is_stable(self):
+        assert annotator_partition('wf-1') == annotator_partition('wf-1')
+        assert 0 <= annotator_partition('wf-1') < ANNOTATOR_PARTITIONS
+
+    def test_shards_cover_every_partition_once(self):
+        shards = [owned_partitions(i, 3) for i in range(3)]
+        assert set().union(*shards) == set(range(ANNOTATOR_PARTITIONS))
+        assert sum(len(s) for s in shards) == ANNOTATOR_PARTITIONS
+        assert owned_partitions(3, 3) == set()
+
+    def test_routing_keys_cover_both_event_types(self):
+        assert partition_routing_keys({2}) == ['image.metadata_extracted.2', 'image.objects_detected.2']
+
+    def test_owned_partition_joins(self, tmp_path):
+        _create_test_image(tmp_path, 'wf-1.jpg')
+        state = {}
+        lock = threading.Lock()
+        ch = MagicMock()
+        method = MagicMock()
+        owned = {annotator_partition('wf-1')}
+        driver = self._driver()
+
+        on_sharded_event(ch, method, self._body('image.metadata_extracted', event_id='e-meta'),
+                         state, lock, driver, owned, images_dir=str(tmp_path))
+        result = on_sharded_event(ch, method, self._body('image.objects_detected', event_id='e-det'),
+                                  state, lock, driver, owned, images_dir=str(tmp_path))
+        assert result['eventType'] == 'image.annotated'
+        assert ch.basic_ack.call_count == 2
+
+    def test_foreign_partition_is_forwarded(self):
+        state = {}
+        lock = threading.Lock()
+        ch = MagicMock()
+        method = MagicMock()
+        method.delivery_tag = 'tag-1'
+
+        result = on_sharded_event(ch, method, self._body('image.metadata_extracted'),
+                                  state, lock, MagicMock(), set())
+        assert result is None
+        assert state == {}
+        ch.basic_publish.assert_called_once()
+        assert ch.basic_publish.call_args[1]['routing_key'] == \
+            f"image.metadata_extracted.{annotator_partition('wf-1')}"
+        ch.basic_ack.assert_called_once_with(delivery_tag='tag-1')
+
+    def test_forward_routed_back_to_us_is_joined(self):
+        state = {}
+        lock = threading.Lock()
+        ch = MagicMock()
+        body = json.dumps({**json.loads(self._body('image.metadata_extracted')),
+                           'forwardedBy': 'annotator-shard-1'}).encode()
+
+        on_sharded_event(ch, MagicMock(), body, state, lock, MagicMock(), set(), queue='annotator-shard-1')
+        assert 'wf-1' in state
+        ch.basic_publish.assert_not_called()
+
+        on_sharded_event(ch, MagicMock(), body, {}, lock, MagicMock(), set(), queue='annotator-shard-0')
+        assert json.loads(ch.basic_publish.call_args[1]['body'])['forwardedBy'] == 'annotator-shard-0'
+
+    def test_redelivered_halves_after_join_are_dropped(self, tmp_path):
+        _create_test_image(tmp_path, 'wf-1.jpg')
+        state = {}
+        lock = threading.Lock()
+        joined = new_joined()
+        ch = MagicMock()
+        owned = {annotator_partition('wf-1')}
+        driver = self._driver()
+        meta = self._body('image.metadata_extracted', event_id='e-meta')
+        det = self._body('image.objects_detected', event_id='e-det')
+
+        on_sharded_event(ch, MagicMock(), meta, state, lock, driver, owned, images_dir=str(tmp_path), joined=joined)
+        on_sharded_event(ch, MagicMock(), det, state, lock, driver, owned, images_dir=str(tmp_path), joined=joined)
+        assert ch.basic_publish.call_count == 1
+
+        # Upstream republishes the cached events on redelivery, with the same eventIds.
+        for body in (meta, det):
+            assert on_sharded_event(ch, MagicMock(), body, state, lock, driver, owned,
+                                    images_dir=str(tmp_path), joined=joined) is None
+        assert state == {}
+        assert ch.basic_publish.call_count == 1
+        assert ch.basic_ack.call_count == 4
+
+    def test_joined_memory_is_bounded(self):
+        joined = new_joined()
+        remember_joined(joined, ['a', 'b'], max_entries=3)
+        remember_joined(joined, ['c', 'd'], max_entries=3)
+        assert list(joined) == ['b', 'c', 'd']
+
+    def test_handoff_republishes_half_joins(self):
+        state = {}
+        lock = threading.Lock()
+        ch = MagicMock()
+        on_metadata(ch, MagicMock(), self._body('image.metadata_extracted', 'wf-1'), state, lock, MagicMock())
+        on_metadata(ch, MagicMock(), self._body('image.metadata_extracted', 'wf-2'), state, lock, MagicMock())
+
+        handed_off = handoff_pending(ch, state, lock, keep=lambda wid: wid == 'wf-2')
+        assert handed_off == ['wf-1']
+        assert list(state) == ['wf-2']
+        ch.basic_publish.assert_called_once()
+        assert json.loads(ch.basic_publish.call_args[1]['body'])['workflowId'] == 'wf-1'
+
+
+class FakeBroker:
+    # Topic bindings only; asserts after every unbind that no partition key is left unrouted.
+    def __init__(self):
+        self.bindings = {}
+
+    def queue_declare(self, queue, durable=False):
+        self.bindings.setdefault(queue, set())
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self.bindings[queue].add(routing_key)
+
+    def queue_unbind(self, queue, exchange, routing_key):
+        self.bindings[queue].discard(routing_key)
+        for key in partition_routing_keys(range(ANNOTATOR_PARTITIONS)):
+            assert self.routes(key), f'{key} is unroutable'
+
+    def routes(self, routing_key):
+        def matches(pattern):
+            return pattern == routing_key or \
+                (pattern.endswith('.#') and routing_key.startswith(pattern[:-1]))
+        return {q for q, patterns in self.bindings.items() if any(matches(p) for p in patterns)}
+
+    def start_unsharded(self):
+        for queue, routing_key in UNSHARDED_QUEUES.items():
+            self.queue_declare(queue)
+            self.queue_bind(queue, EXCHANGE, routing_key)
+
+    def start_shard(self, index, count):
+        self.queue_declare(shard_queue(index))
+        shard_queues = [q for q in self.bindings if q not in UNSHARDED_QUEUES]
+        bind_shard_topology(self, count, shard_queues)
+        return release_unsharded_queues(self, list(self.bindings))
+
+
+class TestReshardRollout:
+    def _assert_topology(self, broker, count):
+        for p in range(ANNOTATOR_PARTITIONS):
+            for routing_key in partition_routing_keys({p}):
+                assert broker.routes(routing_key) == {shard_queue(p % count)}
+
+    def test_scale_up_restarting_old_shards_first(self):
+        broker = FakeBroker()
+        for i in range(2):
+            broker.start_shard(i, 2)
+        self._assert_topology(broker, 2)
+
+        broker.start_shard(0, 3)
+        # Partitions 4 and 10 move to shard 1, which still runs with the old count.
+        assert broker.routes('image.metadata_extracted.4') == {'annotator-shard-1'}
+        self._assert_topology(broker, 3)
+        broker.start_shard(1, 3)
+        broker.start_shard(2, 3)
+        self._assert_topology(broker, 3)
+
+    def test_scale_up_starting_new_shard_first(self):
+        broker = FakeBroker()
+        for i in range(2):
+            broker.start_shard(i, 2)
+        broker.start_shard(2, 3)
+        self._assert_topology(broker, 3)
+
+    def test_switch_from_unsharded(self):
+        broker = FakeBroker()
+        broker.start_unsharded()
+        assert broker.routes('image.objects_detected.7') == {'annotator-detections'}
+
+        assert broker.start_shard(0, 2) == list(UNSHARDED_QUEUES)
+        for queue in UNSHARDED_QUEUES:
+            assert broker.bindings[queue] == set()
+        self._assert_topology(broker, 2)
+        # Until drained and deleted, later shards unbind (a no-op) and drain them again.
+        assert broker.start_shard(1, 2) == list(UNSHARDED_QUEUES)
+        self._assert_topology(broker, 2)
+
+    def test_scale_down_retiring_shard(self):
+        broker = FakeBroker()
+        for i in range(3):
+            broker.start_shard(i, 3)
+        broker.start_shard(0, 2)
+        broker.start_shard(2, 2)
+        assert broker.bindings['annotator-shard-2'] == set()
+        self._assert_topology(broker, 2)
+
+
+class TestDescribeMessage:
+    def test_reports_event_characteristics(self):
+        body = json.dumps({
+            'eventType': 'image.objects_detected',
+            'payload': {'filename': 'wf-1.jpg', 'detections': [{}, {}, {}]},
+        }).encode()
+        assert describe_message(body, None) == {
+            'eventType': 'image.objects_detected', 'detections': 3, 'exifTags': 0, 'joined': False,
+        }
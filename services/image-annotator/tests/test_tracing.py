@@ -0,0 +1,115 @@
+import json
+from unittest.mock import MagicMock
+
+import pika
+import pytest
+
+from tracing import FileExporter, Tracer, parse_traceparent, trace_id_for
+
+
+class _Properties:
+    def __init__(self, headers=None):
+        self.headers = headers
+
+
+class _Collector:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+def _body(workflow_id='0b7e2f4c-1d2e-4f3a-9b8c-7d6e5f4a3b2c'):
+    return json.dumps({'workflowId': workflow_id, 'eventType': 'image.fetched'}).encode()
+
+
+class TestTraceHelpers:
+    def test_trace_id_for_uuid_workflow(self):
+        assert trace_id_for('0b7e2f4c-1d2e-4f3a-9b8c-7d6e5f4a3b2c') == '0b7e2f4c1d2e4f3a9b8c7d6e5f4a3b2c'
+
+    def test_trace_id_for_other_ids_is_stable(self):
+        assert trace_id_for('wf-1') == trace_id_for('wf-1')
+        assert len(trace_id_for('wf-1')) == 32
+
+    def test_parse_traceparent(self):
+        assert parse_traceparent('00-' + 'a' * 32 + '-' + 'b' * 16 + '-01') == ('a' * 32, 'b' * 16)
+        assert parse_traceparent('garbage') == (None, None)
+        assert parse_traceparent(None) == (None, None)
+
+
+class TestTracer:
+    def test_records_queue_and_handle_spans(self):
+        collector = _Collector()
+        tracer = Tracer('svc', collector, _Properties)
+        parent = '00-' + 'a' * 32 + '-' + 'b' * 16 + '-01'
+        properties = _Properties({'traceparent': parent, 'x-published-at': 1000.0})
+
+        with tracer.consume(MagicMock(), properties, _body()):
+            pass
+
+        queue, handle = collector.spans
+        assert queue['name'] == 'queue'
+        assert queue['traceId'] == 'a' * 32
+        assert queue['parentId'] == 'b' * 16
+        assert queue['start'] == 1000.0
+        assert handle['name'] == 'handle'
+        assert handle['parentId'] == queue['spanId']
+        assert handle['service'] == 'svc'
+        assert handle['attributes']['eventType'] == 'image.fetched'
+
+    def test_falls_back_to_workflow_trace(self):
+        collector = _Collector()
+        tracer = Tracer('svc', collector, _Properties)
+
+        with tracer.consume(MagicMock(), _Properties(), _body()):
+            pass
+
+        [handle] = collector.spans
+        assert handle['traceId'] == trace_id_for('0b7e2f4c-1d2e-4f3a-9b8c-7d6e5f4a3b2c')
+        assert handle['parentId'] is None
+
+    def test_publish_carries_trace_headers(self):
+        collector = _Collector()
+        tracer = Tracer('svc', collector, _Properties)
+        channel = MagicMock()
+
+        with tracer.consume(channel, _Properties(), _body()) as traced:
+            traced.basic_publish(exchange='x', routing_key='k', body='{}')
+            traced.basic_ack(delivery_tag='tag-1')
+
+        [handle] = collector.spans
+        properties = channel.basic_publish.call_args[1]['properties']
+        assert properties.headers['traceparent'] == f"00-{handle['traceId']}-{handle['spanId']}-01"
+        assert 'x-published-at' in properties.headers
+        channel.basic_ack.assert_called_once_with(delivery_tag='tag-1')
+
+    def test_publish_headers_encode_with_pika(self):
+        tracer = Tracer('svc', _Collector(), pika.BasicProperties)
+        channel = MagicMock()
+
+        with tracer.consume(channel, pika.BasicProperties(), _body()) as traced:
+            traced.basic_publish(exchange='x', routing_key='k', body='{}')
+
+        properties = channel.basic_publish.call_args[1]['properties']
+        assert isinstance(properties.headers['x-published-at'], int)
+        properties.encode()
+
+    def test_records_errors(self):
+        collector = _Collector()
+        tracer = Tracer('svc', collector, _Properties)
+
+        with pytest.raises(ValueError):
+            with tracer.consume(MagicMock(), _Properties(), _body()):
+                raise ValueError('boom')
+
+        assert 'boom' in collector.spans[0]['attributes']['error']
+
+    def test_file_exporter_appends_json_lines(self, tmp_path):
+        path = tmp_path / 'traces' / 'spans.jsonl'
+        tracer = Tracer('svc', FileExporter(str(path)), _Properties)
+        with tracer.consume(MagicMock(), _Properties(), _body()):
+            pass
+        with tracer.consume(MagicMock(), _Properties(), _body()):
+            pass
+        assert [json.loads(line)['name'] for line in path.read_text().splitlines()] == ['handle', 'handle']
@@ -1,4 +1,6 @@
-const { fetchAndProcessImage, buildFetchedEvent, recordEvent, handleMessage } = require('../lib');
+const {
+  fetchAndProcessImage, buildFetchedEvent, recordEvent, handleMessage, startTrace, traceHeaders,
+} = require('../lib');
 
 jest.mock('uuid', () => ({ v4: () => 'test-uuid' }));
 
@@ -60,15 +62,23 @@ describe('buildFetchedEvent', () => {
     expect(event.eventType).toBe('image.fetched');
     expect(event.workflowId).toBe('wf-1');
     expect(event.payload.filename).toBe('wf-1.jpg');
+    expect(event.causationId).toBeNull();
+    expect(event.correlationId).toBe('wf-1');
+  });
+
+  it('carries causation and correlation ids from the triggering event', () => {
+    const event = buildFetchedEvent('wf-1', { filename: 'wf-1.jpg' }, { eventId: 'e-0', correlationId: 'corr-1' });
+    expect(event.causationId).toBe('e-0');
+    expect(event.correlationId).toBe('corr-1');
   });
 });
 
 describe('recordEvent', () => {
-  it('records event in Neo4j with TRIGGERS when prevEventType given', async () => {
+  it('records event in Neo4j with TRIGGERS when prevEventId given', async () => {
     const session = { run: jest.fn().mockResolvedValue(), close: jest.fn().mockResolvedValue() };
     const driver = { session: () => session };
     const event = { workflowId: 'wf-1', eventId: 'e-1', eventType: 'image.fetched', timestamp: 't' };
-    await recordEvent(driver, event, 'workflow.started', 'wf-1');
+    await recordEvent(driver, event, 'e-0', 'wf-1');
     expect(session.run).toHaveBeenCalledTimes(2);
     expect(session.close).toHaveBeenCalled();
   });
@@ -99,3 +109,22 @@ describe('handleMessage', () => {
     expect(channel.publish).toHaveBeenCalled();
   });
 });
+
+describe('startTrace', () => {
+  const traceId = 'a'.repeat(32);
+  const parentId = 'b'.repeat(16);
+
+  it('continues the trace from message headers', () => {
+    const msg = { properties: { headers: { traceparent: `00-${traceId}-${parentId}-01`, 'x-published-at': 1000 } } };
+    const trace = startTrace('image-fetcher', msg, { workflowId: 'wf-1', eventType: 'workflow.started' });
+    expect(trace.traceId).toBe(traceId);
+    expect(trace.parentId).not.toBe(parentId); // parent is the queue-wait span
+    expect(traceHeaders(trace).traceparent).toBe(`00-${traceId}-${trace.spanId}-01`);
+  });
+
+  it('falls back to the workflow id without headers', () => {
+    const trace = startTrace('image-fetcher', { properties: {} }, { workflowId: 'ab-cd' });
+    expect(trace.traceId).toBe('abcd');
+    expect(trace.parentId).toBeNull();
+  });
+});
@@ -1,10 +1,48 @@
+const crypto = require('crypto');
+const fs = require('fs');
 const path = require('path');
 const { v4: uuidv4 } = require('uuid');
 
 const EXCHANGE = 'imageanalyzer.events';
 const USER_AGENT = 'ImageAnalyzer/1.0';
 
-async function recordEvent(driver, event, prevEventType, workflowId) {
+function newSpanId() {
+  return crypto.randomBytes(8).toString('hex');
+}
+
+function exportSpan(span) {
+  if (!process.env.TRACE_FILE) return;
+  const record = { ...span, durationMs: span.end - span.start };
+  fs.appendFileSync(process.env.TRACE_FILE, JSON.stringify(record) + '\n');
+}
+
+function startTrace(service, msg, event) {
+  const headers = (msg.properties && msg.properties.headers) || {};
+  const match = /^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$/.exec(headers.traceparent || '');
+  const traceId = match ? match[1] : event.workflowId.replace(/-/g, '');
+  let parentId = match ? match[2] : null;
+  const start = Date.now();
+  const attributes = { workflowId: event.workflowId, eventType: event.eventType };
+  if (headers['x-published-at'] !== undefined) {
+    const spanId = newSpanId();
+    exportSpan({
+      traceId, spanId, parentId, service, name: 'queue',
+      start: Number(headers['x-published-at']), end: start, attributes,
+    });
+    parentId = spanId;
+  }
+  return { traceId, spanId: newSpanId(), parentId, service, name: 'handle', start, attributes };
+}
+
+function traceHeaders(trace) {
+  return { traceparent: `00-${trace.traceId}-${trace.spanId}-01`, 'x-published-at': Date.now() };
+}
+
+function endTrace(trace) {
+  exportSpan({ ...trace, end: Date.now() });
+}
+
+async function recordEvent(driver, event, prevEventId, workflowId) {
   const session = driver.session();
   try {
     await session.run(
@@ -13,12 +51,11 @@ async function recordEvent(driver, event, prevEventType, workflowId) {
        CREATE (e)-[:BELONGS_TO]->(w)`,
       { wid: workflowId, eid: event.eventId, type: event.eventType, ts: event.timestamp }
     );
-    if (prevEventType) {
+    if (prevEventId) {
       await session.run(
-        `MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType})
-         MATCH (cur:Event {id: $curId})
-         CREATE (prev)-[:TRIGGERS]->(cur)`,
-        { wid: workflowId, prevType: prevEventType, curId: event.eventId }
+        `MATCH (prev:Event {id: $prev}), (cur:Event {id: $cur})
+         MERGE (prev)-[:TRIGGERS]->(cur)`,
+        { prev: prevEventId, cur: event.eventId }
       );
     }
   } finally {
@@ -54,11 +91,13 @@ async function fetchAndProcessImage({ axios, sharp, fs, imageUrl, workflowId, im
   };
 }
 
-function buildFetchedEvent(workflowId, payload) {
+function buildFetchedEvent(workflowId, payload, cause = {}) {
   return {
     eventId: uuidv4(),
     eventType: 'image.fetched',
     workflowId,
+    causationId: cause.eventId || null,
+    correlationId: cause.correlationId || workflowId,
     timestamp: new Date().toISOString(),
     payload,
   };
@@ -68,12 +107,20 @@ async function handleMessage({ channel, driver, axios, sharp, fs, imagesDir }, m
   const event = JSON.parse(msg.content.toString());
   const { workflowId, payload } = event;
   const { imageUrl } = payload;
+  const trace = startTrace('image-fetcher', msg, event);
 
-  const result = await fetchAndProcessImage({ axios, sharp, fs, imageUrl, workflowId, imagesDir });
-  const outEvent = buildFetchedEvent(workflowId, result);
-  channel.publish(EXCHANGE, 'image.fetched', Buffer.from(JSON.stringify(outEvent)));
-  await recordEvent(driver, outEvent, 'workflow.started', workflowId);
-  return outEvent;
+  try {
+    const result = await fetchAndProcessImage({ axios, sharp, fs, imageUrl, workflowId, imagesDir });
+    const outEvent = buildFetchedEvent(workflowId, result, event);
+    channel.publish(EXCHANGE, 'image.fetched', Buffer.from(JSON.stringify(outEvent)), { headers: traceHeaders(trace) });
+    await recordEvent(driver, outEvent, outEvent.causationId, workflowId);
+    return outEvent;
+  } finally {
+    endTrace(trace);
+  }
 }
 
-module.exports = { EXCHANGE, recordEvent, fetchAndProcessImage, buildFetchedEvent, handleMessage };
+module.exports = {
+  EXCHANGE, recordEvent, fetchAndProcessImage, buildFetchedEvent, handleMessage,
+  startTrace, traceHeaders, endTrace,
+};
@@ -0,0 +1,133 @@
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AimdController:
+    def __init__(self, min_workers=1, max_workers=4, target_latency_ms=None, decrease_factor=0.5):
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.target_latency_ms = target_latency_ms
+        self.decrease_factor = decrease_factor
+
+    def next_limit(self, limit, depth, latency_ms):
+        # Latency over target: back off multiplicatively (more threads are only adding contention).
+        if self.target_latency_ms and latency_ms is not None and latency_ms > self.target_latency_ms:
+            return max(self.min_workers, int(limit * self.decrease_factor))
+        # Backlog beyond what is already in flight: grow one worker per sample.
+        if depth > limit:
+            return min(self.max_workers, limit + 1)
+        # Idle queue: shrink one worker per sample.
+        if depth == 0:
+            return max(self.min_workers, limit - 1)
+        return limit
+
+
+# pika channels are not thread-safe; workers hand publishes and acks to the connection thread.
+class ThreadSafeChannel:
+    def __init__(self, connection, channel):
+        self._connection = connection
+        self._channel = channel
+
+    def basic_publish(self, **kwargs):
+        self._connection.add_callback_threadsafe(functools.partial(self._channel.basic_publish, **kwargs))
+
+    def basic_ack(self, **kwargs):
+        self._connection.add_callback_threadsafe(functools.partial(self._channel.basic_ack, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+# Runs the callback on a thread pool, with the prefetch count as the concurrency limit:
+# the broker never has more than `limit` unacked messages out to us. The prefetch is
+# channel-wide (global_qos): a per-consumer prefetch is fixed when basic_consume runs,
+# so later basic_qos calls would never reach the running consumer. Every `interval`
+# seconds the queue depth (passive declare) and the mean latency of the messages
+# finished since the last sample go through the controller, and basic_qos is updated.
+# Lowering the prefetch does not revoke deliveries, so scale-down drains in-flight work.
+# A message whose callback raises is republished with an `x-attempts` header; after
+# `max_attempts` it is parked in `<queue>.failed` instead of being dropped.
+class AdaptiveConsumer:
+    def __init__(self, connection, channel, queue, callback, controller, interval=5.0,
+                 properties_class=None, max_attempts=5):
+        self.connection = connection
+        self.channel = channel
+        self.queue = queue
+        self.callback = callback
+        self.controller = controller
+        self.interval = interval
+        self.properties_class = properties_class
+        self.max_attempts = max_attempts
+        self.failed_queue = f'{queue}.failed'
+        self.limit = controller.min_workers
+        self.inflight = 0
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.safe_channel = ThreadSafeChannel(connection, channel)
+        self.executor = ThreadPoolExecutor(max_workers=controller.max_workers)
+        self.sample_channel = None
+
+    def start(self):
+        self.sample_channel = self.connection.channel()
+        self.channel.queue_declare(queue=self.failed_queue, durable=True)
+        self.channel.basic_qos(prefetch_count=self.limit, global_qos=True)
+        self.channel.basic_consume(queue=self.queue, on_message_callback=self._dispatch)
+        self.connection.call_later(self.interval, self._tick)
+
+    def _dispatch(self, ch, method, properties, body):
+        with self.lock:
+            self.inflight += 1
+        self.executor.submit(self._run, method, properties, body)
+
+    def _run(self, method, properties, body):
+        start = time.perf_counter()
+        try:
+            self.callback(self.safe_channel, method, properties, body)
+        except Exception as err:
+            self._retry(method, properties, body, err)
+        finally:
+            with self.lock:
+                self.inflight -= 1
+                self.latencies.append((time.perf_counter() - start) * 1000)
+
+    def _retry(self, method, properties, body, err):
+        headers = dict(getattr(properties, 'headers', None) or {})
+        attempts = int(headers.get('x-attempts', 0)) + 1
+        target = self.queue if attempts < self.max_attempts else self.failed_queue
+        print(f'Error handling message (attempt {attempts}/{self.max_attempts}), '
+              f'moving it to {target}: {err!r}')
+        headers.update({'x-attempts': attempts, 'x-last-error': repr(err)[:500]})
+        # Publish and ack are queued in order on the connection thread: republish first.
+        self.safe_channel.basic_publish(exchange='', routing_key=target, body=body,
+                                        properties=self.properties_class(headers=headers, delivery_mode=2))
+        self.safe_channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def sample(self):
+        depth = self.sample_channel.queue_declare(queue=self.queue, passive=True).method.message_count
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        latency_ms = sum(latencies) / len(latencies) if latencies else None
+        return depth, latency_ms
+
+    def _tick(self):
+        depth, latency_ms = self.sample()
+        limit = self.controller.next_limit(self.limit, depth, latency_ms)
+        if limit != self.limit:
+            latency = f'{latency_ms:.0f}ms' if latency_ms is not None else 'n/a'
+            print(f'Concurrency {self.limit} -> {limit} (depth {depth}, latency {latency})')
+            self.limit = limit
+            self.channel.basic_qos(prefetch_count=limit, global_qos=True)
+        self.connection.call_later(self.interval, self._tick)
+
+    def drain(self, poll=0.1):
+        # Stop new deliveries, then keep the connection loop running so workers can ack.
+        self.channel.stop_consuming()
+        while True:
+            with self.lock:
+                if self.inflight == 0:
+                    break
+            self.connection.process_data_events(time_limit=poll)
+        self.executor.shutdown(wait=True)
+        self.connection.process_data_events(time_limit=0)
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+
+class SqliteStore:
+    def __init__(self, path, max_rows=100000):
+        self.max_rows = max_rows
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed (event_id TEXT PRIMARY KEY, result TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, event_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT result FROM processed WHERE event_id = ?", (event_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, event_id, result):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO processed (event_id, result) VALUES (?, ?)",
+                (event_id, json.dumps(result)),
+            )
+            self.conn.execute(
+                "DELETE FROM processed WHERE rowid <= (SELECT MAX(rowid) FROM processed) - ?",
+                (self.max_rows,),
+            )
+            self.conn.commit()
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT event_id FROM processed")]
+
+
+# Maps an incoming eventId to the event we published for it. The Bloom filter answers the
+# common "never seen" case; possible hits go to the bounded LRU, then the optional store.
+class DedupCache:
+    def __init__(self, max_entries=1024, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        remembered = store.max_rows if store is not None else max_entries
+        self.bloom = BloomFilter(remembered * 2)
+        if store is not None:
+            for event_id in store.keys():
+                self.bloom.add(event_id)
+
+    def get(self, event_id):
+        if not event_id:
+            return None
+        with self.lock:
+            if event_id not in self.bloom:
+                return None
+            if event_id in self.entries:
+                self.entries.move_to_end(event_id)
+                return self.entries[event_id]
+        if self.store is not None:
+            return self.store.get(event_id)
+        return None
+
+    def put(self, event_id, result):
+        if not event_id:
+            return
+        with self.lock:
+            if self.bloom.count >= self.bloom.capacity:
+                self._rebuild_bloom()
+            self.bloom.add(event_id)
+            self.entries[event_id] = result
+            self.entries.move_to_end(event_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.store is not None:
+            self.store.put(event_id, result)
+
+    def _rebuild_bloom(self):
+        # Only the LRU (and the store, if any) can still answer hits, so the filter
+        # is rebuilt from them instead of growing its false-positive rate forever.
+        self.bloom.clear()
+        keys = self.store.keys() if self.store is not None else self.entries.keys()
+        for event_id in keys:
+            self.bloom.add(event_id)
@@ -1,37 +1,104 @@
+import fnmatch
 import json
 import os
 import uuid
+import zlib
 from datetime import datetime, timezone
 
 EXCHANGE = 'imageanalyzer.events'
 IMAGES_DIR = '/data/images'
+ANNOTATOR_PARTITIONS = 16
+DEFAULT_EXIF_DENY = [
+    'JPEGThumbnail', 'TIFFThumbnail', 'EXIF MakerNote', 'MakerNote *',
+    'Image PrintIM', 'Image ApplicationNotes', 'EXIF UserComment',
+]
+DEFAULT_EXIF_MAX_VALUE_BYTES = 256
+# exifread field types (index into exifread.tags.FIELD_TYPES)
+INTEGER_FIELD_TYPES = {1, 3, 4, 6, 8, 9}
+REAL_FIELD_TYPES = {5, 10, 11, 12}
 
 
-def record_event(neo4j_driver, event, prev_event_type):
+def annotator_partition(workflow_id):
+    # Must match image-annotator: both halves of a join are routed to the same shard.
+    return zlib.crc32(workflow_id.encode()) % ANNOTATOR_PARTITIONS
+
+
+def record_event(neo4j_driver, event, prev_event_id):
     with neo4j_driver.session() as session:
         session.run(
             "MERGE (w:Workflow {id: $wid}) "
-            "CREATE (e:Event {id: $eid, type: $type, timestamp: $ts}) "
-            "CREATE (e)-[:BELONGS_TO]->(w)",
+            "MERGE (e:Event {id: $eid}) "
+            "ON CREATE SET e.type = $type, e.timestamp = $ts "
+            "MERGE (e)-[:BELONGS_TO]->(w)",
             wid=event['workflowId'], eid=event['eventId'],
             type=event['eventType'], ts=event['timestamp']
         )
-        if prev_event_type:
+        if prev_event_id:
             session.run(
-                "MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType}) "
+                "MATCH (prev:Event {id: $prevId}) "
                 "MATCH (cur:Event {id: $curId}) "
-                "CREATE (prev)-[:TRIGGERS]->(cur)",
-                wid=event['workflowId'], prevType=prev_event_type, curId=event['eventId']
+                "MERGE (prev)-[:TRIGGERS]->(cur)",
+                prevId=prev_event_id, curId=event['eventId']
             )
 
 
-def extract_metadata(filepath, exifread_module, pil_image_class):
+def build_exif_policy(allow=None, deny=None, max_value_bytes=DEFAULT_EXIF_MAX_VALUE_BYTES, exif_tags=None):
+    allow = list(allow or [])
+    policy = {
+        'allow': allow,
+        'deny': list(DEFAULT_EXIF_DENY if deny is None else deny),
+        'max_value_bytes': max_value_bytes,
+        'stop_tag': None,
+    }
+    # exifread stops reading an IFD at stop_tag. IFD entries are sorted by tag id, so with an
+    # exact allow-list we can stop at the allowed tag with the highest id; when that is below
+    # ExifOffset/GPSInfo the sub-IFDs are never read at all.
+    if allow and exif_tags and not any(any(c in key for c in '*?[') for key in allow):
+        ids = {entry[0]: tag_id for tag_id, entry in exif_tags.items()}
+        names = [key.split(' ', 1)[-1] for key in allow]
+        if all(name in ids for name in names):
+            policy['stop_tag'] = max(names, key=ids.get)
+    return policy
+
+
+def exif_tag_allowed(key, policy):
+    if policy['allow'] and not any(fnmatch.fnmatchcase(key, p) for p in policy['allow']):
+        return False
+    return not any(fnmatch.fnmatchcase(key, p) for p in policy['deny'])
+
+
+def exif_value(tag, max_value_bytes):
+    field_type = getattr(tag, 'field_type', None)
+    values = getattr(tag, 'values', None)
+    # Keep single numbers typed, unless exifread printed them as something else (e.g. an enum label).
+    if isinstance(values, list) and len(values) == 1 and str(tag) == str(values[0]):
+        try:
+            if field_type in INTEGER_FIELD_TYPES:
+                return int(values[0])
+            if field_type in REAL_FIELD_TYPES:
+                return round(float(values[0]), 6)
+        except (TypeError, ValueError, ZeroDivisionError):
+            pass
+    text = str(tag)
+    encoded = text.encode()
+    if max_value_bytes and len(encoded) > max_value_bytes:
+        return encoded[:max_value_bytes].decode(errors='ignore')
+    return text
+
+
+def extract_metadata(filepath, exifread_module, pil_image_class, policy=None):
+    if policy is None:
+        policy = build_exif_policy()
     exif = {}
     try:
         with open(filepath, 'rb') as f:
-            tags = exifread_module.process_file(f, details=False)
+            options = {'details': False}
+            if policy['stop_tag']:
+                options['stop_tag'] = policy['stop_tag']
+            tags = exifread_module.process_file(f, **options)
             for k, v in tags.items():
-                exif[k] = str(v)
+                if exif_tag_allowed(k, policy):
+                    exif[k] = exif_value(v, policy['max_value_bytes'])
     except Exception:
         pass
 
@@ -46,7 +113,8 @@ def extract_metadata(filepath, exifread_module, pil_image_class):
     return exif
 
 
-def handle_message(ch, method, body, neo4j_driver, exifread_module, pil_image_class, images_dir=None):
+def handle_message(ch, method, body, neo4j_driver, exifread_module, pil_image_class, images_dir=None,
+                   dedup=None, exif_policy=None):
     if images_dir is None:
         images_dir = IMAGES_DIR
     event = json.loads(body)
@@ -54,20 +122,45 @@ def handle_message(ch, method, body, neo4j_driver, exifread_module, pil_image_cl
     filename = event['payload']['filename']
     filepath = os.path.join(images_dir, filename)
 
-    metadata = extract_metadata(filepath, exifread_module, pil_image_class)
+    cached = dedup.get(event.get('eventId')) if dedup is not None else None
+    if cached is not None:
+        # Redelivery of a message we already handled: republish the same event, skip the work.
+        ch.basic_publish(exchange=EXCHANGE,
+                         routing_key=f'image.metadata_extracted.{annotator_partition(workflow_id)}',
+                         body=json.dumps(cached))
+        # Recording is idempotent: this fills in the graph if the first delivery died before it.
+        record_event(neo4j_driver, cached, cached['causationId'])
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return cached
+
+    metadata = extract_metadata(filepath, exifread_module, pil_image_class, exif_policy)
 
     out_event = {
         'eventId': str(uuid.uuid4()),
         'eventType': 'image.metadata_extracted',
         'workflowId': workflow_id,
+        'causationId': event.get('eventId'),
+        'correlationId': event.get('correlationId', workflow_id),
         'timestamp': datetime.now(timezone.utc).isoformat(),
         'payload': {
             'filename': filename,
             'metadata': {'exif': metadata},
         },
     }
-    ch.basic_publish(exchange=EXCHANGE, routing_key='image.metadata_extracted',
+    if dedup is not None:
+        dedup.put(event.get('eventId'), out_event)
+    ch.basic_publish(exchange=EXCHANGE,
+                     routing_key=f'image.metadata_extracted.{annotator_partition(workflow_id)}',
                      body=json.dumps(out_event))
-    record_event(neo4j_driver, out_event, 'image.fetched')
+    record_event(neo4j_driver, out_event, out_event['causationId'])
     ch.basic_ack(delivery_tag=method.delivery_tag)
     return out_event
+
+
+def describe_message(body, result):
+    exif = result['payload']['metadata']['exif'] if result else {}
+    return {
+        'imageWidth': exif.get('ImageWidth'),
+        'imageHeight': exif.get('ImageHeight'),
+        'exifTags': len(exif),
+    }
@@ -1,20 +1,60 @@
 import os
+import signal
 
 import pika
 import exifread
 from PIL import Image
 from neo4j import GraphDatabase
 
-from logic import EXCHANGE, handle_message
+from concurrency import AdaptiveConsumer, AimdController
+from dedup import DedupCache, SqliteStore
+import logic
+from logic import EXCHANGE, DEFAULT_EXIF_MAX_VALUE_BYTES, handle_message, describe_message, build_exif_policy
+from profiling import setup_profiling
+from tracing import setup_tracing
 
 neo4j_driver = GraphDatabase.driver(
     os.environ['NEO4J_URI'],
     auth=(os.environ['NEO4J_USER'], os.environ['NEO4J_PASSWORD'])
 )
 
+dedup_store = SqliteStore(os.environ['DEDUP_DB']) if os.environ.get('DEDUP_DB') else None
+dedup = DedupCache(int(os.environ.get('DEDUP_CACHE_SIZE', '1024')), dedup_store)
+
+
+def _env_list(name):
+    value = os.environ.get(name)
+    return [item.strip() for item in value.split(',') if item.strip()] if value is not None else None
+
+
+exif_policy = build_exif_policy(
+    allow=_env_list('EXIF_ALLOW'),
+    deny=_env_list('EXIF_DENY'),
+    max_value_bytes=int(os.environ.get('EXIF_MAX_VALUE_BYTES', DEFAULT_EXIF_MAX_VALUE_BYTES)),
+    exif_tags=exifread.tags.exif.EXIF_TAGS,
+)
+
+profiler = setup_profiling(logic, ['extract_metadata', 'record_event'], describe_message)
+tracer = setup_tracing('metadata-extractor', pika.BasicProperties)
+
 
 def on_message(ch, method, properties, body):
-    handle_message(ch, method, body, neo4j_driver, exifread, Image)
+    with tracer.consume(ch, properties, body) as traced_ch:
+        return handle_message(traced_ch, method, body, neo4j_driver, exifread, Image, dedup=dedup,
+                              exif_policy=exif_policy)
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def concurrency_controller():
+    target = os.environ.get('CONCURRENCY_TARGET_MS')
+    return AimdController(
+        min_workers=int(os.environ.get('CONCURRENCY_MIN', '1')),
+        max_workers=int(os.environ.get('CONCURRENCY_MAX', '4')),
+        target_latency_ms=float(target) if target else None,
+    )
 
 
 def main():
@@ -24,9 +64,20 @@ def main():
     channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic', durable=True)
     channel.queue_declare(queue='metadata-extractor', durable=True)
     channel.queue_bind(queue='metadata-extractor', exchange=EXCHANGE, routing_key='image.fetched')
-    channel.basic_consume(queue='metadata-extractor', on_message_callback=on_message)
+    consumer = AdaptiveConsumer(connection, channel, 'metadata-extractor', profiler.wrap(on_message),
+                                concurrency_controller(), interval=float(os.environ.get('CONCURRENCY_INTERVAL', '5')),
+                                properties_class=pika.BasicProperties,
+                                max_attempts=int(os.environ.get('MAX_ATTEMPTS', '5')))
+    consumer.start()
     print('Metadata Extractor waiting for messages...')
-    channel.start_consuming()
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.drain()
+        connection.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,231 @@
+import heapq
+import itertools
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Opt-in profiler for the consumer callback. While disabled, the wrapped callback only
+# checks a flag: stage timers are patched into the logic module on enable() and removed
+# again on disable(), and the stack sampler thread only runs while enabled.
+class Profiler:
+    def __init__(self, module, stages, describe=None, slowest=20, interval=0.005, out_dir='/tmp'):
+        self.module = module
+        self.stages = stages
+        self.describe = describe
+        self.slowest_n = slowest
+        self.interval = interval
+        self.out_dir = out_dir
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.slowest = []
+        self.stacks = Counter()
+        self._originals = {}
+        self._seq = itertools.count()
+        self._generation = 0
+        # Per-thread stage timings, and the threads the sampler should look at, since
+        # the adaptive consumer can run several callbacks at once.
+        self._local = threading.local()
+        self._targets = set()
+
+    def enable(self):
+        with self.lock:
+            if self.enabled:
+                return
+            for name in self.stages:
+                fn = getattr(self.module, name)
+                self._originals[name] = fn
+                setattr(self.module, name, self._timed(name, fn))
+            self.enabled = True
+            # A sampler from an earlier enable may still be asleep; the new generation retires it.
+            self._generation += 1
+            generation = self._generation
+        threading.Thread(target=self._sample, args=(generation,), daemon=True).start()
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            for name, fn in self._originals.items():
+                setattr(self.module, name, fn)
+            self._originals = {}
+            self.enabled = False
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+        print(f"Profiling {'enabled' if self.enabled else 'disabled'}")
+
+    def wrap(self, callback):
+        def wrapped(ch, method, properties, body):
+            if not self.enabled:
+                return callback(ch, method, properties, body)
+            return self._profile_call(callback, ch, method, properties, body)
+        return wrapped
+
+    def _timed(self, name, fn):
+        # Stages record self time: a stage called from inside another one is subtracted from
+        # the outer stage, so the breakdown plus 'other' still adds up to the total.
+        def timed(*args, **kwargs):
+            outer_nested = getattr(self._local, 'nested', 0.0)
+            self._local.nested = 0.0
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                current = getattr(self._local, 'current', None)
+                if current is not None:
+                    current[name] = current.get(name, 0.0) + elapsed - self._local.nested
+                self._local.nested = outer_nested + elapsed
+        return timed
+
+    def _profile_call(self, callback, ch, method, properties, body):
+        self._local.current = {}
+        target = threading.get_ident()
+        self._targets.add(target)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = callback(ch, method, properties, body)
+            return result
+        finally:
+            total = time.perf_counter() - start
+            stages, self._local.current = self._local.current, None
+            self._targets.discard(target)
+            self._record(total, stages, body, result)
+
+    def _record(self, total, stages, body, result):
+        stages_ms = {name: round(seconds * 1000, 2) for name, seconds in stages.items()}
+        stages_ms['other'] = round((total - sum(stages.values())) * 1000, 2)
+        try:
+            characteristics = self.describe(body, result) if self.describe else {}
+        except Exception:
+            characteristics = {}
+        entry = {
+            'durationMs': round(total * 1000, 2),
+            'stagesMs': stages_ms,
+            'input': characteristics,
+            'at': datetime.now(timezone.utc).isoformat(),
+        }
+        item = (total, next(self._seq), entry)
+        with self.lock:
+            if len(self.slowest) < self.slowest_n:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def _sample(self, generation):
+        while True:
+            time.sleep(self.interval)
+            if not self.enabled or generation != self._generation:
+                return
+            frames = sys._current_frames()
+            for target in list(self._targets):
+                frame = frames.get(target)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def slowest_messages(self):
+        with self.lock:
+            return [entry for _, _, entry in sorted(self.slowest, reverse=True)]
+
+    def collapsed_stacks(self):
+        with self.lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def reset(self):
+        with self.lock:
+            self.slowest = []
+            self.stacks = Counter()
+
+    def dump(self):
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+        stacks_path = os.path.join(self.out_dir, f'profile-{stamp}.folded')
+        slowest_path = os.path.join(self.out_dir, f'slowest-{stamp}.json')
+        with open(stacks_path, 'w') as f:
+            f.write(self.collapsed_stacks())
+        with open(slowest_path, 'w') as f:
+            json.dump(self.slowest_messages(), f, indent=2)
+        print(f'Profile written to {stacks_path} and {slowest_path}')
+        return stacks_path, slowest_path
+
+
+def _in_thread(fn):
+    # Signal handlers run on the main thread, possibly while it holds profiler.lock (the
+    # annotator's callback runs there), so do the work elsewhere instead of deadlocking.
+    return lambda signum, frame: threading.Thread(target=fn, daemon=True).start()
+
+
+def install_signal_handlers(profiler):
+    # SIGUSR1 toggles profiling, SIGUSR2 dumps collapsed stacks and the slowest messages.
+    signal.signal(signal.SIGUSR1, _in_thread(profiler.toggle))
+    signal.signal(signal.SIGUSR2, _in_thread(profiler.dump))
+
+
+def serve_http(profiler, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/profiling':
+                self._send(200, json.dumps({
+                    'enabled': profiler.enabled,
+                    'slowest': profiler.slowest_messages(),
+                }), 'application/json')
+            elif self.path == '/profiling/stacks':
+                self._send(200, profiler.collapsed_stacks(), 'text/plain')
+            else:
+                self._send(404, '', 'text/plain')
+
+        def do_POST(self):
+            actions = {
+                '/profiling/enable': profiler.enable,
+                '/profiling/disable': profiler.disable,
+                '/profiling/reset': profiler.reset,
+            }
+            if self.path not in actions:
+                return self._send(404, '', 'text/plain')
+            actions[self.path]()
+            self._send(200, json.dumps({'enabled': profiler.enabled}), 'application/json')
+
+        def _send(self, status, body, content_type):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def setup_profiling(module, stages, describe=None):
+    profiler = Profiler(
+        module, stages, describe,
+        slowest=int(os.environ.get('PROFILING_SLOWEST', '20')),
+        out_dir=os.environ.get('PROFILING_DIR', '/tmp'),
+    )
+    install_signal_handlers(profiler)
+    if os.environ.get('PROFILING_PORT'):
+        serve_http(profiler, int(os.environ['PROFILING_PORT']))
+    if os.environ.get('PROFILING') == '1':
+        profiler.enable()
+    return profiler
@@ -0,0 +1,183 @@
+import threading
+import time
+import types
+
+from concurrency import AdaptiveConsumer, AimdController, ThreadSafeChannel
+
+
+class FakeConnection:
+    def __init__(self, sample_channel=None):
+        self.callbacks = []
+        self.timers = []
+        self.sample_channel = sample_channel
+        self.lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def call_later(self, delay, callback):
+        self.timers.append((delay, callback))
+
+    def channel(self):
+        return self.sample_channel
+
+    def process_data_events(self, time_limit=0):
+        with self.lock:
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        time.sleep(time_limit)
+
+
+class FakeChannel:
+    def __init__(self, depth=0):
+        self.depth = depth
+        self.calls = []
+
+    def basic_publish(self, **kwargs):
+        self.calls.append(('publish', kwargs))
+
+    def basic_ack(self, **kwargs):
+        self.calls.append(('ack', kwargs))
+
+    def basic_qos(self, prefetch_count, global_qos=False):
+        # A per-consumer (non-global) prefetch would not change an existing consumer.
+        self.calls.append(('qos', (prefetch_count, global_qos)))
+
+    def basic_consume(self, queue, on_message_callback):
+        self.calls.append(('consume', queue))
+
+    def stop_consuming(self):
+        self.calls.append(('stop', None))
+
+    def queue_declare(self, queue, passive=False, durable=False):
+        if not passive:
+            self.calls.append(('declare', queue))
+        return types.SimpleNamespace(method=types.SimpleNamespace(message_count=self.depth))
+
+
+class Properties:
+    def __init__(self, headers=None, delivery_mode=None):
+        self.headers = headers
+        self.delivery_mode = delivery_mode
+
+
+def _method(tag=1):
+    return types.SimpleNamespace(delivery_tag=tag)
+
+
+class TestAimdController:
+    def test_grows_by_one_while_backlog_exceeds_limit(self):
+        controller = AimdController(min_workers=1, max_workers=3)
+        assert controller.next_limit(1, 10, 50) == 2
+        assert controller.next_limit(3, 10, 50) == 3
+
+    def test_halves_when_latency_over_target(self):
+        controller = AimdController(min_workers=1, max_workers=8, target_latency_ms=100)
+        assert controller.next_limit(8, 50, 250) == 4
+        assert controller.next_limit(1, 50, 250) == 1
+
+    def test_shrinks_when_idle_and_holds_otherwise(self):
+        controller = AimdController(min_workers=1, max_workers=4)
+        assert controller.next_limit(3, 0, None) == 2
+        assert controller.next_limit(1, 0, None) == 1
+        assert controller.next_limit(3, 2, None) == 3
+
+
+class TestThreadSafeChannel:
+    def test_defers_publish_and_ack_to_connection_thread(self):
+        connection, channel = FakeConnection(), FakeChannel()
+        safe = ThreadSafeChannel(connection, channel)
+        safe.basic_publish(exchange='x', routing_key='k', body=b'{}')
+        safe.basic_ack(delivery_tag=7)
+        assert channel.calls == []
+
+        connection.process_data_events()
+        assert [c[0] for c in channel.calls] == ['publish', 'ack']
+        assert channel.calls[1][1] == {'delivery_tag': 7}
+
+
+class TestAdaptiveConsumer:
+    def _consumer(self, callback, depth=0, **kwargs):
+        channel, sample_channel = FakeChannel(), FakeChannel(depth)
+        connection = FakeConnection(sample_channel)
+        consumer = AdaptiveConsumer(connection, channel, 'q', callback, AimdController(1, 4, **kwargs),
+                                    interval=1, properties_class=Properties, max_attempts=3)
+        consumer.start()
+        return consumer, connection, channel, sample_channel
+
+    def test_start_sets_prefetch_and_schedules_sampling(self):
+        consumer, connection, channel, _ = self._consumer(lambda *args: None)
+        assert channel.calls == [('declare', 'q.failed'), ('qos', (1, True)), ('consume', 'q')]
+        assert connection.timers[0][0] == 1
+
+    def test_tick_raises_prefetch_under_backlog(self):
+        consumer, connection, channel, _ = self._consumer(lambda *args: None, depth=20)
+        connection.timers.pop()[1]()
+        connection.timers.pop()[1]()
+        assert consumer.limit == 3
+        assert channel.calls[-1] == ('qos', (3, True))
+        assert len(connection.timers) == 1
+
+    def test_tick_backs_off_on_slow_messages(self):
+        def slow(ch, method, properties, body):
+            time.sleep(0.03)
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        consumer, connection, channel, _ = self._consumer(slow, depth=20, target_latency_ms=10)
+        consumer.limit = 4
+        consumer._dispatch(channel, _method(), None, b'{}')
+        consumer.drain(poll=0.01)
+        connection.timers.pop()[1]()
+        assert consumer.limit == 2
+        assert consumer.latencies == []
+
+    def test_workers_run_concurrently_and_drain_acks(self):
+        started = threading.Barrier(3, timeout=2)
+
+        def callback(ch, method, properties, body):
+            started.wait()
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+        consumer, connection, channel, _ = self._consumer(callback)
+        for tag in (1, 2, 3):
+            consumer._dispatch(channel, _method(tag), None, b'{}')
+        consumer.drain(poll=0.01)
+
+        acks = sorted(kwargs['delivery_tag'] for name, kwargs in channel.calls if name == 'ack')
+        assert acks == [1, 2, 3]
+        assert ('stop', None) in channel.calls
+        assert consumer.inflight == 0
+        assert len(consumer.latencies) == 3
+
+    def test_failed_message_is_requeued_with_attempt_count(self):
+        def boom(ch, method, properties, body):
+            raise RuntimeError('neo4j unavailable')
+
+        consumer, connection, channel, _ = self._consumer(boom)
+        consumer._dispatch(channel, _method(9), Properties({'traceparent': 'tp'}), b'{"a": 1}')
+        consumer.drain(poll=0.01)
+
+        [publish] = [kwargs for name, kwargs in channel.calls if name == 'publish']
+        assert publish['routing_key'] == 'q'
+        assert publish['body'] == b'{"a": 1}'
+        assert publish['properties'].headers['x-attempts'] == 1
+        assert publish['properties'].headers['traceparent'] == 'tp'
+        assert publish['properties'].delivery_mode == 2
+        names = [name for name, _ in channel.calls]
+        assert names.index('publish') < names.index('ack')
+
+    def test_message_is_parked_after_max_attempts(self):
+        def boom(ch, method, properties, body):
+            raise RuntimeError('bad image')
+
+        consumer, connection, channel, _ = self._consumer(boom)
+        consumer._dispatch(channel, _method(9), Properties({'x-attempts': 2}), b'{}')
+        consumer.drain(poll=0.01)
+
+        [publish] = [kwargs for name, kwargs in channel.calls if name == 'publish']
+        assert publish['routing_key'] == 'q.failed'
+        assert publish['properties'].headers['x-attempts'] == 3
+        assert 'bad image' in publish['properties'].headers['x-last-error']
+        assert ('ack', {'delivery_tag': 9}) in channel.calls
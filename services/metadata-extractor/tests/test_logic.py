@@ -1,7 +1,13 @@
 import json
+from fractions import Fraction
 from unittest.mock import MagicMock, patch, mock_open
 
-from logic import extract_metadata, record_event, handle_message
+from dedup import DedupCache
+
+from logic import (
+    extract_metadata, record_event, handle_message, annotator_partition, describe_message,
+    build_exif_policy, exif_tag_allowed, exif_value,
+)
 
 
 class TestExtractMetadata:
@@ -50,6 +56,77 @@ class TestExtractMetadata:
         assert result == {}
 
 
+class _Tag:
+    def __init__(self, printable, field_type, values):
+        self.printable = printable
+        self.field_type = field_type
+        self.values = values
+
+    def __str__(self):
+        return self.printable
+
+
+def _jpeg_with_exif(path):
+    from PIL import Image
+
+    exif = Image.Exif()
+    exif[0x010F] = 'Canon'
+    exif[0x0110] = 'EOS'
+    exif.get_ifd(0x8769)[0x9003] = '2024:01:01 10:00:00'
+    Image.new('RGB', (32, 24)).save(str(path), 'JPEG', exif=exif.tobytes())
+
+
+class TestExifPolicy:
+    EXIF_TAGS = {0x010F: ('Make', ), 0x0110: ('Model', ), 0x8769: ('ExifOffset', ), 0x9003: ('DateTimeOriginal', )}
+
+    def test_default_denies_blobs(self):
+        policy = build_exif_policy()
+        assert exif_tag_allowed('Image Make', policy)
+        assert not exif_tag_allowed('JPEGThumbnail', policy)
+        assert not exif_tag_allowed('MakerNote Tag 0x0001', policy)
+
+    def test_allow_list_restricts_tags(self):
+        policy = build_exif_policy(allow=['Image Make', 'GPS *'])
+        assert exif_tag_allowed('Image Make', policy)
+        assert exif_tag_allowed('GPS GPSLatitude', policy)
+        assert not exif_tag_allowed('Image Model', policy)
+
+    def test_stop_tag_is_highest_allowed_tag(self):
+        policy = build_exif_policy(allow=['Image Model', 'Image Make'], exif_tags=self.EXIF_TAGS)
+        assert policy['stop_tag'] == 'Model'
+        policy = build_exif_policy(allow=['Image Make', 'EXIF DateTimeOriginal'], exif_tags=self.EXIF_TAGS)
+        assert policy['stop_tag'] == 'DateTimeOriginal'
+
+    def test_no_stop_tag_for_patterns_or_unknown_tags(self):
+        assert build_exif_policy(allow=['GPS *'], exif_tags=self.EXIF_TAGS)['stop_tag'] is None
+        assert build_exif_policy(allow=['Image Unknown'], exif_tags=self.EXIF_TAGS)['stop_tag'] is None
+        assert build_exif_policy(exif_tags=self.EXIF_TAGS)['stop_tag'] is None
+
+    def test_numbers_stay_typed(self):
+        assert exif_value(_Tag('3000', 4, [3000]), 256) == 3000
+        assert exif_value(_Tag('14/5', 5, [Fraction(14, 5)]), 256) == 2.8
+
+    def test_enum_labels_stay_printable(self):
+        assert exif_value(_Tag('Horizontal (normal)', 3, [1]), 256) == 'Horizontal (normal)'
+
+    def test_caps_value_size(self):
+        assert exif_value(_Tag('x' * 1000, 7, [0] * 1000), 16) == 'x' * 16
+
+    def test_stop_tag_skips_rest_of_file(self, tmp_path):
+        import exifread
+
+        path = tmp_path / 'exif.jpg'
+        _jpeg_with_exif(path)
+        policy = build_exif_policy(allow=['Image Make'], exif_tags=exifread.tags.exif.EXIF_TAGS)
+        pil_img = MagicMock()
+        pil_img.open.side_effect = Exception('skip')
+
+        exifread_mod = MagicMock(wraps=exifread)
+        result = extract_metadata(str(path), exifread_mod, pil_img, policy)
+        assert result == {'Image Make': 'Canon'}
+        assert exifread_mod.process_file.call_args[1]['stop_tag'] == 'Make'
+
+
 class TestRecordEvent:
     def test_records_event_with_triggers(self):
         session = MagicMock()
@@ -58,8 +135,10 @@ class TestRecordEvent:
         driver.session.return_value.__exit__ = MagicMock(return_value=False)
 
         event = {'workflowId': 'wf-1', 'eventId': 'e-1', 'eventType': 'image.metadata_extracted', 'timestamp': 't'}
-        record_event(driver, event, 'image.fetched')
+        record_event(driver, event, 'e-0')
         assert session.run.call_count == 2
+        assert session.run.call_args[1] == {'prevId': 'e-0', 'curId': 'e-1'}
+        assert 'MERGE (e:Event {id: $eid})' in session.run.call_args_list[0][0][0]
 
     def test_records_event_without_triggers(self):
         session = MagicMock()
@@ -101,6 +180,8 @@ class TestHandleMessage:
         assert result['eventType'] == 'image.metadata_extracted'
         assert result['workflowId'] == 'wf-1'
         ch.basic_publish.assert_called_once()
+        assert ch.basic_publish.call_args[1]['routing_key'] == \
+            f"image.metadata_extracted.{annotator_partition('wf-1')}"
         ch.basic_ack.assert_called_once_with(delivery_tag='tag-1')
 
     def test_event_envelope_structure(self, tmp_path):
@@ -132,3 +213,68 @@ class TestHandleMessage:
         assert 'timestamp' in result
         assert result['payload']['filename'] == 'wf-1.jpg'
         assert 'exif' in result['payload']['metadata']
+
+    def test_carries_causation_and_correlation_ids(self, tmp_path):
+        ch = MagicMock()
+        method = MagicMock()
+        body = json.dumps({
+            'eventId': 'e-fetched',
+            'workflowId': 'wf-1',
+            'correlationId': 'corr-1',
+            'payload': {'filename': 'wf-1.jpg'},
+        }).encode()
+
+        exifread_mod = MagicMock()
+        exifread_mod.process_file.return_value = {}
+        pil_img = MagicMock()
+        pil_img.open.return_value = MagicMock(width=800, height=600, format='JPEG')
+
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+
+        result = handle_message(ch, method, body, driver, exifread_mod, pil_img, images_dir=str(tmp_path))
+
+        assert result['causationId'] == 'e-fetched'
+        assert result['correlationId'] == 'corr-1'
+        assert session.run.call_args[1]['prevId'] == 'e-fetched'
+
+    def test_redelivery_republishes_cached_event(self, tmp_path):
+        ch = MagicMock()
+        method = MagicMock()
+        body = json.dumps({
+            'eventId': 'e-fetched',
+            'workflowId': 'wf-1',
+            'payload': {'filename': 'wf-1.jpg'},
+        }).encode()
+
+        exifread_mod = MagicMock()
+        exifread_mod.process_file.return_value = {}
+        pil_img = MagicMock()
+        pil_img.open.return_value = MagicMock(width=800, height=600, format='JPEG')
+
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+        dedup = DedupCache(max_entries=8)
+
+        first = handle_message(ch, method, body, driver, exifread_mod, pil_img,
+                               images_dir=str(tmp_path), dedup=dedup)
+        second = handle_message(ch, method, body, driver, exifread_mod, pil_img,
+                                images_dir=str(tmp_path), dedup=dedup)
+
+        assert second == first
+        assert pil_img.open.call_count == 1
+        assert ch.basic_publish.call_count == 2
+        assert ch.basic_ack.call_count == 2
+        # The event is recorded again (idempotently) in case the first delivery crashed before it.
+        assert [c[1]['eid'] for c in session.run.call_args_list if 'eid' in c[1]] == \
+            [first['eventId']] * 2
+
+
+class TestDescribeMessage:
+    def test_reports_dimensions_and_tag_count(self):
+        result = {'payload': {'metadata': {'exif': {'ImageWidth': 800, 'ImageHeight': 600, 'Image Make': 'Canon'}}}}
+        assert describe_message(b'{}', result) == {'imageWidth': 800, 'imageHeight': 600, 'exifTags': 3}
@@ -0,0 +1,122 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+
+def trace_id_for(workflow_id):
+    # One trace per workflow, so spans can still be grouped if a hop drops the header.
+    try:
+        return uuid.UUID(str(workflow_id)).hex
+    except ValueError:
+        return uuid.uuid5(uuid.NAMESPACE_URL, str(workflow_id)).hex
+
+
+def parse_traceparent(value):
+    match = TRACEPARENT.match(value or '')
+    return (match.group(1), match.group(2)) if match else (None, None)
+
+
+def now_ms():
+    return time.time() * 1000
+
+
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def export(self, span):
+        line = json.dumps(span) + '\n'
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+# Publishes through the wrapped channel with the current span as trace parent.
+class TracedChannel:
+    def __init__(self, channel, tracer, trace_id, span_id):
+        self._channel = channel
+        self._tracer = tracer
+        self._trace_id = trace_id
+        self._span_id = span_id
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        headers = {
+            'traceparent': f'00-{self._trace_id}-{self._span_id}-01',
+            # AMQP header tables (pika) have no float type; whole ms like Node's Date.now().
+            'x-published-at': int(now_ms()),
+        }
+        if properties is None:
+            properties = self._tracer.properties_class(headers=headers)
+        else:
+            properties.headers = {**(properties.headers or {}), **headers}
+        return self._channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                           properties=properties, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+class Tracer:
+    def __init__(self, service, exporter=None, properties_class=None):
+        self.service = service
+        self.exporter = exporter
+        self.properties_class = properties_class
+
+    def _export(self, trace_id, span_id, parent_id, name, start, end, attributes):
+        if self.exporter is None:
+            return
+        self.exporter.export({
+            'traceId': trace_id,
+            'spanId': span_id,
+            'parentId': parent_id,
+            'service': self.service,
+            'name': name,
+            'start': start,
+            'end': end,
+            'durationMs': round(end - start, 3),
+            'attributes': attributes,
+        })
+
+    @contextmanager
+    def consume(self, channel, properties, body):
+        received = now_ms()
+        headers = getattr(properties, 'headers', None) or {}
+        try:
+            event = json.loads(body)
+        except ValueError:
+            event = {}
+        trace_id, parent_id = parse_traceparent(headers.get('traceparent'))
+        if trace_id is None:
+            trace_id = trace_id_for(event.get('workflowId'))
+        attributes = {'workflowId': event.get('workflowId'), 'eventType': event.get('eventType')}
+
+        published_at = headers.get('x-published-at')
+        if published_at is not None:
+            queue_span_id = new_span_id()
+            self._export(trace_id, queue_span_id, parent_id, 'queue', float(published_at), received, attributes)
+            parent_id = queue_span_id
+
+        span_id = new_span_id()
+        try:
+            yield TracedChannel(channel, self, trace_id, span_id)
+        except Exception as err:
+            attributes = {**attributes, 'error': repr(err)}
+            raise
+        finally:
+            self._export(trace_id, span_id, parent_id, 'handle', received, now_ms(), attributes)
+
+
+def setup_tracing(service, properties_class):
+    path = os.environ.get('TRACE_FILE')
+    return Tracer(service, FileExporter(path) if path else None, properties_class)
@@ -71,7 +71,7 @@ describe('recordEvent', () => {
     const session = { run: jest.fn().mockResolvedValue(), close: jest.fn().mockResolvedValue() };
     const driver = { session: () => session };
     const event = { workflowId: 'wf-1', eventId: 'e-1', eventType: 'notification.sent', timestamp: 't' };
-    await recordEvent(driver, event, 'image.stored');
+    await recordEvent(driver, event, 'e-0');
     expect(session.run).toHaveBeenCalledTimes(2);
   });
 });
@@ -2,7 +2,7 @@ const { v4: uuidv4 } = require('uuid');
 
 const EXCHANGE = 'imageanalyzer.events';
 
-async function recordEvent(driver, event, prevEventType) {
+async function recordEvent(driver, event, prevEventId) {
   const session = driver.session();
   try {
     await session.run(
@@ -11,12 +11,11 @@ async function recordEvent(driver, event, prevEventType) {
        CREATE (e)-[:BELONGS_TO]->(w)`,
       { wid: event.workflowId, eid: event.eventId, type: event.eventType, ts: event.timestamp }
     );
-    if (prevEventType) {
+    if (prevEventId) {
       await session.run(
-        `MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType})
-         MATCH (cur:Event {id: $curId})
-         CREATE (prev)-[:TRIGGERS]->(cur)`,
-        { wid: event.workflowId, prevType: prevEventType, curId: event.eventId }
+        `MATCH (prev:Event {id: $prev}), (cur:Event {id: $cur})
+         MERGE (prev)-[:TRIGGERS]->(cur)`,
+        { prev: prevEventId, cur: event.eventId }
       );
     }
   } finally {
@@ -66,10 +65,12 @@ async function handleMessage({ driver, transporter, channel }, msg) {
     eventId: uuidv4(),
     eventType: 'notification.sent',
     workflowId,
+    causationId: event.eventId || null,
+    correlationId: event.correlationId || workflowId,
     timestamp: new Date().toISOString(),
     payload: { recipient: email },
   };
-  await recordEvent(driver, outEvent, 'image.stored');
+  await recordEvent(driver, outEvent, outEvent.causationId);
   return outEvent;
 }
 
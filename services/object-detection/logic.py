@@ -1,28 +1,38 @@
 import json
 import os
+import time
 import uuid
+import zlib
 from datetime import datetime, timezone
 
 EXCHANGE = 'imageanalyzer.events'
 IMAGES_DIR = '/data/images'
+ANNOTATOR_PARTITIONS = 16
 MAX_DETECTIONS = 20
+ASPECT_TOLERANCE = 0.02
 
 
-def record_event(neo4j_driver, event, prev_event_type):
+def annotator_partition(workflow_id):
+    # Must match image-annotator: both halves of a join are routed to the same shard.
+    return zlib.crc32(workflow_id.encode()) % ANNOTATOR_PARTITIONS
+
+
+def record_event(neo4j_driver, event, prev_event_id):
     with neo4j_driver.session() as session:
         session.run(
             "MERGE (w:Workflow {id: $wid}) "
-            "CREATE (e:Event {id: $eid, type: $type, timestamp: $ts}) "
-            "CREATE (e)-[:BELONGS_TO]->(w)",
+            "MERGE (e:Event {id: $eid}) "
+            "ON CREATE SET e.type = $type, e.timestamp = $ts "
+            "MERGE (e)-[:BELONGS_TO]->(w)",
             wid=event['workflowId'], eid=event['eventId'],
             type=event['eventType'], ts=event['timestamp']
         )
-        if prev_event_type:
+        if prev_event_id:
             session.run(
-                "MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType}) "
+                "MATCH (prev:Event {id: $prevId}) "
                 "MATCH (cur:Event {id: $curId}) "
-                "CREATE (prev)-[:TRIGGERS]->(cur)",
-                wid=event['workflowId'], prevType=prev_event_type, curId=event['eventId']
+                "MERGE (prev)-[:TRIGGERS]->(cur)",
+                prevId=prev_event_id, curId=event['eventId']
             )
 
 
@@ -35,14 +45,50 @@ def record_entities(neo4j_driver, workflow_id, detections):
                 "MERGE (e:Entity {label: $label}) "
                 "WITH e "
                 "MATCH (w:Workflow {id: $wid}) "
-                "CREATE (w)-[:DETECTED {confidence: $conf, bbox: $bbox}]->(e)",
+                "MERGE (w)-[d:DETECTED {bbox: $bbox}]->(e) "
+                "SET d.confidence = $conf",
                 label=det['label'], wid=workflow_id,
                 conf=det['confidence'], bbox=det['bbox']
             )
 
 
 def detect_objects(filepath, model):
-    results = model(filepath, verbose=False)
+    return format_detections(model(filepath, verbose=False), model)
+
+
+def detect_objects_batch(filepaths, model):
+    results = model(filepaths, batch=len(filepaths), verbose=False)
+    return [format_detections([r], model) for r in results]
+
+
+def build_cascade_policy(imgsz, min_confidence=0.5, min_box_fraction=0.01):
+    return {'imgsz': imgsz, 'min_confidence': min_confidence, 'min_box_fraction': min_box_fraction}
+
+
+def needs_escalation(detections, image_size, policy):
+    # Nothing found counts as uncertain too (max confidence 0): small objects are exactly
+    # what a low-resolution pass misses.
+    if max((d['confidence'] for d in detections), default=0.0) < policy['min_confidence']:
+        return True
+    width, height = image_size
+    return any((d['bbox'][2] - d['bbox'][0]) * (d['bbox'][3] - d['bbox'][1])
+               < policy['min_box_fraction'] * width * height for d in detections)
+
+
+def detect_objects_cascade(filepath, model, policy):
+    start = time.perf_counter()
+    results = model(filepath, imgsz=policy['imgsz'], verbose=False)
+    detections = format_detections(results, model)
+    height, width = results[0].orig_shape
+    stats = {'tier': 'low', 'lowMs': round((time.perf_counter() - start) * 1000, 1)}
+    if needs_escalation(detections, (width, height), policy):
+        start = time.perf_counter()
+        detections = detect_objects(filepath, model)
+        stats.update(tier='full', fullMs=round((time.perf_counter() - start) * 1000, 1))
+    return detections, stats
+
+
+def format_detections(results, model):
     detections = []
     for r in results:
         for box in r.boxes:
@@ -56,7 +102,33 @@ def detect_objects(filepath, model):
     return detections
 
 
-def handle_message(ch, method, body, neo4j_driver, model, images_dir=None):
+def rescale_detections(detections, from_size, to_size):
+    sx, sy = to_size[0] / from_size[0], to_size[1] / from_size[1]
+    return [
+        {**det, 'bbox': [round(det['bbox'][0] * sx, 1), round(det['bbox'][1] * sy, 1),
+                         round(det['bbox'][2] * sx, 1), round(det['bbox'][3] * sy, 1)]}
+        for det in detections
+    ]
+
+
+def same_aspect(a, b, tolerance=ASPECT_TOLERANCE):
+    return abs(a[0] * b[1] - a[1] * b[0]) <= tolerance * a[0] * b[1]
+
+
+def find_near_duplicate(near_dupes, filepath):
+    image_hash, size = near_dupes.fingerprint(filepath)
+    # The hash is taken from a fixed 9x8 thumbnail, so it cannot tell a 640x480 image from a
+    # 480x640 one; only reuse detections from an image with the same shape.
+    match = near_dupes.lookup(image_hash, accept=lambda entry: same_aspect(entry['size'], size))
+    if match is None:
+        return (image_hash, size), None, None
+    distance, entry = match
+    detections = rescale_detections(entry['detections'], entry['size'], size)
+    return (image_hash, size), detections, {'workflowId': entry['workflowId'], 'distance': distance}
+
+
+def handle_message(ch, method, body, neo4j_driver, model, images_dir=None,
+                   dedup=None, near_dupes=None, cascade=None):
     if images_dir is None:
         images_dir = IMAGES_DIR
     event = json.loads(body)
@@ -64,21 +136,63 @@ def handle_message(ch, method, body, neo4j_driver, model, images_dir=None):
     filename = event['payload']['filename']
     filepath = os.path.join(images_dir, filename)
 
-    detections = detect_objects(filepath, model)
+    cached = dedup.get(event.get('eventId')) if dedup is not None else None
+    if cached is not None:
+        # Redelivery of a message we already handled: republish the same event, skip the work.
+        ch.basic_publish(exchange=EXCHANGE,
+                         routing_key=f'image.objects_detected.{annotator_partition(workflow_id)}',
+                         body=json.dumps(cached))
+        # Recording is idempotent: this fills in the graph if the first delivery died before it.
+        record_event(neo4j_driver, cached, cached['causationId'])
+        record_entities(neo4j_driver, workflow_id, cached['payload']['detections'])
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+        return cached
+
+    detections = reused_from = cascade_stats = None
+    if near_dupes is not None:
+        # Re-encoded or resized copy of an image we already analyzed: reuse its detections.
+        (image_hash, size), detections, reused_from = find_near_duplicate(near_dupes, filepath)
+    if detections is None:
+        if cascade is not None:
+            detections, cascade_stats = detect_objects_cascade(filepath, model, cascade)
+        else:
+            detections = detect_objects(filepath, model)
+        if near_dupes is not None:
+            near_dupes.add(image_hash, {'workflowId': workflow_id, 'size': list(size),
+                                        'detections': detections})
 
     out_event = {
         'eventId': str(uuid.uuid4()),
         'eventType': 'image.objects_detected',
         'workflowId': workflow_id,
+        'causationId': event.get('eventId'),
+        'correlationId': event.get('correlationId', workflow_id),
         'timestamp': datetime.now(timezone.utc).isoformat(),
         'payload': {
             'filename': filename,
             'detections': detections,
         },
     }
-    ch.basic_publish(exchange=EXCHANGE, routing_key='image.objects_detected',
+    if reused_from is not None:
+        out_event['payload']['reusedFrom'] = reused_from
+    if cascade_stats is not None:
+        out_event['payload']['cascade'] = cascade_stats
+    if dedup is not None:
+        dedup.put(event.get('eventId'), out_event)
+    ch.basic_publish(exchange=EXCHANGE,
+                     routing_key=f'image.objects_detected.{annotator_partition(workflow_id)}',
                      body=json.dumps(out_event))
-    record_event(neo4j_driver, out_event, 'image.fetched')
+    record_event(neo4j_driver, out_event, out_event['causationId'])
     record_entities(neo4j_driver, workflow_id, detections)
     ch.basic_ack(delivery_tag=method.delivery_tag)
     return out_event
+
+
+def describe_message(body, result, images_dir=None):
+    filename = json.loads(body)['payload']['filename']
+    filepath = os.path.join(images_dir or IMAGES_DIR, filename)
+    return {
+        'imageBytes': os.path.getsize(filepath) if os.path.exists(filepath) else None,
+        'detections': len(result['payload']['detections']) if result else None,
+        'cascadeTier': result['payload'].get('cascade', {}).get('tier') if result else None,
+    }
@@ -1,21 +1,76 @@
 import os
+import signal
+import threading
 
 import pika
 from neo4j import GraphDatabase
+from PIL import Image
 from ultralytics import YOLO
 
-from logic import EXCHANGE, handle_message
+from concurrency import AdaptiveConsumer, AimdController
+from dedup import DedupCache, SqliteStore
+import logic
+from perceptual import HashStore, NearDuplicateIndex
+from logic import EXCHANGE, handle_message, describe_message, build_cascade_policy
+from profiling import setup_profiling
+from tracing import setup_tracing
 
 neo4j_driver = GraphDatabase.driver(
     os.environ['NEO4J_URI'],
     auth=(os.environ['NEO4J_USER'], os.environ['NEO4J_PASSWORD'])
 )
 
-model = YOLO('yolov8n.pt')
+# Ultralytics predictors are not thread-safe, so each consumer worker gets its own model.
+models = threading.local()
+
+
+def get_model():
+    if not hasattr(models, 'model'):
+        models.model = YOLO('yolov8n.pt')
+    return models.model
+
+
+dedup_store = SqliteStore(os.environ['DEDUP_DB']) if os.environ.get('DEDUP_DB') else None
+dedup = DedupCache(int(os.environ.get('DEDUP_CACHE_SIZE', '1024')), dedup_store)
+
+near_dupes = None
+if os.environ.get('NEAR_DUPLICATE_DISTANCE'):
+    near_dupes_distance = int(os.environ['NEAR_DUPLICATE_DISTANCE'])
+    near_dupes_max = int(os.environ.get('NEAR_DUPLICATE_MAX_ENTRIES', '100000'))
+    near_dupes_store = HashStore(os.environ['NEAR_DUPLICATE_DB'], near_dupes_max) \
+        if os.environ.get('NEAR_DUPLICATE_DB') else None
+    near_dupes = NearDuplicateIndex(Image, near_dupes_distance, near_dupes_max, near_dupes_store)
+
+cascade = None
+if os.environ.get('DETECTION_CASCADE_IMGSZ'):
+    cascade = build_cascade_policy(
+        int(os.environ['DETECTION_CASCADE_IMGSZ']),
+        float(os.environ.get('DETECTION_CASCADE_MIN_CONFIDENCE', '0.5')),
+        float(os.environ.get('DETECTION_CASCADE_MIN_BOX_FRACTION', '0.01')),
+    )
+
+profiler = setup_profiling(logic, ['find_near_duplicate', 'detect_objects_cascade', 'detect_objects',
+                                   'record_event', 'record_entities'], describe_message)
+tracer = setup_tracing('object-detection', pika.BasicProperties)
 
 
 def on_message(ch, method, properties, body):
-    handle_message(ch, method, body, neo4j_driver, model)
+    with tracer.consume(ch, properties, body) as traced_ch:
+        return handle_message(traced_ch, method, body, neo4j_driver, get_model(), dedup=dedup,
+                              near_dupes=near_dupes, cascade=cascade)
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def concurrency_controller():
+    target = os.environ.get('CONCURRENCY_TARGET_MS')
+    return AimdController(
+        min_workers=int(os.environ.get('CONCURRENCY_MIN', '1')),
+        max_workers=int(os.environ.get('CONCURRENCY_MAX', '4')),
+        target_latency_ms=float(target) if target else None,
+    )
 
 
 def main():
@@ -25,9 +80,20 @@ def main():
     channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic', durable=True)
     channel.queue_declare(queue='object-detection', durable=True)
     channel.queue_bind(queue='object-detection', exchange=EXCHANGE, routing_key='image.fetched')
-    channel.basic_consume(queue='object-detection', on_message_callback=on_message)
+    consumer = AdaptiveConsumer(connection, channel, 'object-detection', profiler.wrap(on_message),
+                                concurrency_controller(), interval=float(os.environ.get('CONCURRENCY_INTERVAL', '5')),
+                                properties_class=pika.BasicProperties,
+                                max_attempts=int(os.environ.get('MAX_ATTEMPTS', '5')))
+    consumer.start()
     print('Object Detection waiting for messages...')
-    channel.start_consuming()
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    try:
+        channel.start_consuming()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.drain()
+        connection.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+
+import numpy as np
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(image, size=8):
+    # Difference hash: one bit per horizontally adjacent pixel pair of a (size+1) x size
+    # grayscale thumbnail. Re-encoding and resizing barely move it.
+    image = image.convert('L').resize((size + 1, size))
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def _to_signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+class HashStore:
+    def __init__(self, path, max_rows=100000):
+        self.max_rows = max_rows
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS image_hashes (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "hash INTEGER NOT NULL, entry TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def put(self, image_hash, entry):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO image_hashes (hash, entry) VALUES (?, ?)",
+                (_to_signed(image_hash), json.dumps(entry)),
+            )
+            self.conn.execute(
+                "DELETE FROM image_hashes WHERE id <= (SELECT MAX(id) FROM image_hashes) - ?",
+                (self.max_rows,),
+            )
+            self.conn.commit()
+
+    def rows(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT hash, entry FROM image_hashes ORDER BY id").fetchall()
+        return [(h & ((1 << 64) - 1), json.loads(entry)) for h, entry in rows]
+
+
+# Hashes live in a packed uint64 ring buffer, so a lookup is one vectorized XOR + popcount
+# over every entry. Entries hold what is needed to reuse a result: the source workflow,
+# its image size and its detections. With a store, the index is rebuilt from it at startup.
+class NearDuplicateIndex:
+    def __init__(self, image_class, max_distance=4, max_entries=100000, store=None):
+        self.image_class = image_class
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.store = store
+        self.hashes = np.zeros(max_entries, dtype=np.uint64)
+        self.entries = [None] * max_entries
+        self.count = 0
+        self.lock = threading.Lock()
+        if store is not None:
+            for image_hash, entry in store.rows()[-max_entries:]:
+                self._append(image_hash, entry)
+
+    def __len__(self):
+        return min(self.count, self.max_entries)
+
+    def fingerprint(self, filepath):
+        with self.image_class.open(filepath) as image:
+            size = image.size
+            # For JPEGs, decode at reduced scale: the hash only needs a 9x8 thumbnail.
+            image.draft('L', (64, 64))
+            return dhash(image), size
+
+    def _append(self, image_hash, entry):
+        slot = self.count % self.max_entries
+        self.hashes[slot] = image_hash
+        self.entries[slot] = entry
+        self.count += 1
+
+    def add(self, image_hash, entry):
+        with self.lock:
+            self._append(image_hash, entry)
+        if self.store is not None:
+            self.store.put(image_hash, entry)
+
+    def lookup(self, image_hash, accept=None):
+        # Closest entry within max_distance that `accept` (if given) agrees to reuse.
+        with self.lock:
+            n = len(self)
+            if n == 0:
+                return None
+            xor = self.hashes[:n] ^ np.uint64(image_hash)
+            distances = POPCOUNT[xor.view(np.uint8)].reshape(n, 8).sum(axis=1)
+            candidates = np.flatnonzero(distances <= self.max_distance)
+            for i in candidates[np.argsort(distances[candidates], kind='stable')]:
+                entry = self.entries[i]
+                if accept is None or accept(entry):
+                    return int(distances[i]), entry
+            return None
@@ -0,0 +1,60 @@
+from dedup import BloomFilter, DedupCache, SqliteStore
+
+
+class TestBloomFilter:
+    def test_contains_added_keys(self):
+        bloom = BloomFilter(100)
+        bloom.add('e-1')
+        assert 'e-1' in bloom
+        assert 'e-2' not in bloom
+
+    def test_clear(self):
+        bloom = BloomFilter(100)
+        bloom.add('e-1')
+        bloom.clear()
+        assert 'e-1' not in bloom
+        assert bloom.count == 0
+
+
+class TestDedupCache:
+    def test_miss_then_hit(self):
+        cache = DedupCache(max_entries=4)
+        assert cache.get('e-1') is None
+        cache.put('e-1', {'eventId': 'out-1'})
+        assert cache.get('e-1') == {'eventId': 'out-1'}
+
+    def test_ignores_missing_event_id(self):
+        cache = DedupCache(max_entries=4)
+        cache.put(None, {'eventId': 'out-1'})
+        assert cache.get(None) is None
+
+    def test_evicts_least_recently_used(self):
+        cache = DedupCache(max_entries=2)
+        cache.put('e-1', {'n': 1})
+        cache.put('e-2', {'n': 2})
+        cache.get('e-1')
+        cache.put('e-3', {'n': 3})
+        assert cache.get('e-2') is None
+        assert cache.get('e-1') == {'n': 1}
+        assert cache.get('e-3') == {'n': 3}
+
+    def test_bloom_is_rebuilt_when_full(self):
+        cache = DedupCache(max_entries=2)
+        for i in range(10):
+            cache.put(f'e-{i}', {'n': i})
+        assert cache.bloom.count <= cache.bloom.capacity
+        assert cache.get('e-9') == {'n': 9}
+
+    def test_persistent_store_survives_restart(self, tmp_path):
+        path = str(tmp_path / 'dedup.db')
+        DedupCache(max_entries=2, store=SqliteStore(path)).put('e-1', {'eventId': 'out-1'})
+
+        restarted = DedupCache(max_entries=2, store=SqliteStore(path))
+        assert restarted.get('e-1') == {'eventId': 'out-1'}
+        assert restarted.get('e-2') is None
+
+    def test_store_is_bounded(self, tmp_path):
+        store = SqliteStore(str(tmp_path / 'dedup.db'), max_rows=3)
+        for i in range(5):
+            store.put(f'e-{i}', {'n': i})
+        assert sorted(store.keys()) == ['e-2', 'e-3', 'e-4']
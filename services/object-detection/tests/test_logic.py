@@ -1,7 +1,15 @@
 import json
 from unittest.mock import MagicMock
 
-from logic import detect_objects, record_event, record_entities, handle_message, MAX_DETECTIONS
+from PIL import Image
+
+from dedup import DedupCache
+from perceptual import NearDuplicateIndex
+
+from logic import (
+    detect_objects, detect_objects_batch, describe_message, record_event, record_entities, handle_message, annotator_partition, rescale_detections,
+    build_cascade_policy, detect_objects_cascade, needs_escalation, MAX_DETECTIONS,
+)
 
 
 def _make_box(cls_id, conf, bbox):
@@ -48,6 +56,62 @@ class TestDetectObjects:
         detections = detect_objects('/fake/path.jpg', model)
         assert detections == []
 
+    def test_batch_returns_one_list_per_image(self):
+        model = MagicMock()
+        model.names = {0: 'cat'}
+        first = MagicMock()
+        first.boxes = [_make_box(0, 0.9, [0, 0, 10, 10])]
+        second = MagicMock()
+        second.boxes = []
+        model.return_value = [first, second]
+
+        detections = detect_objects_batch(['/a.jpg', '/b.jpg'], model)
+        model.assert_called_once_with(['/a.jpg', '/b.jpg'], batch=2, verbose=False)
+        assert [len(d) for d in detections] == [1, 0]
+
+
+def _cascade_model(low_boxes, full_boxes, orig_shape=(480, 640)):
+    model = MagicMock()
+    model.names = {0: 'cat'}
+
+    def run(filepath, verbose=False, imgsz=None):
+        result = MagicMock()
+        result.orig_shape = orig_shape
+        result.boxes = low_boxes if imgsz == 320 else full_boxes
+        return [result]
+
+    model.side_effect = run
+    return model
+
+
+class TestCascade:
+    def test_confident_low_tier_is_kept(self):
+        model = _cascade_model([_make_box(0, 0.9, [0, 0, 200, 200])], [])
+        detections, stats = detect_objects_cascade('/fake.jpg', model, build_cascade_policy(320))
+
+        assert detections[0]['confidence'] == 0.9
+        assert stats['tier'] == 'low'
+        assert 'fullMs' not in stats
+        assert model.call_count == 1
+
+    def test_low_confidence_escalates_to_full(self):
+        model = _cascade_model([_make_box(0, 0.3, [0, 0, 200, 200])],
+                               [_make_box(0, 0.8, [0, 0, 210, 210])])
+        detections, stats = detect_objects_cascade('/fake.jpg', model, build_cascade_policy(320))
+
+        assert detections[0]['confidence'] == 0.8
+        assert stats['tier'] == 'full'
+        assert {'lowMs', 'fullMs'} <= set(stats)
+        assert model.call_args_list[1].kwargs.get('imgsz') is None
+
+    def test_uncertainty_band(self):
+        policy = build_cascade_policy(320, min_confidence=0.5, min_box_fraction=0.01)
+        big = {'confidence': 0.9, 'bbox': [0, 0, 100, 100]}
+        tiny = {'confidence': 0.9, 'bbox': [0, 0, 10, 10]}
+        assert not needs_escalation([big], (640, 480), policy)
+        assert needs_escalation([big, tiny], (640, 480), policy)
+        assert needs_escalation([], (640, 480), policy)
+
 
 class TestRecordEvent:
     def test_records_with_triggers(self):
@@ -57,7 +121,7 @@ class TestRecordEvent:
         driver.session.return_value.__exit__ = MagicMock(return_value=False)
 
         event = {'workflowId': 'wf-1', 'eventId': 'e-1', 'eventType': 'image.objects_detected', 'timestamp': 't'}
-        record_event(driver, event, 'image.fetched')
+        record_event(driver, event, 'e-0')
         assert session.run.call_count == 2
 
 
@@ -94,6 +158,7 @@ class TestHandleMessage:
         method.delivery_tag = 'tag-1'
 
         body = json.dumps({
+            'eventId': 'e-fetched',
             'workflowId': 'wf-1',
             'payload': {'filename': 'wf-1.jpg'},
         }).encode()
@@ -112,6 +177,10 @@ class TestHandleMessage:
         result = handle_message(ch, method, body, driver, model, images_dir=str(tmp_path))
 
         assert result['eventType'] == 'image.objects_detected'
+        assert result['causationId'] == 'e-fetched'
+        assert result['correlationId'] == 'wf-1'
+        assert ch.basic_publish.call_args[1]['routing_key'] == \
+            f"image.objects_detected.{annotator_partition('wf-1')}"
         assert len(result['payload']['detections']) == 1
         ch.basic_publish.assert_called_once()
         ch.basic_ack.assert_called_once_with(delivery_tag='tag-1')
@@ -145,3 +214,124 @@ class TestHandleMessage:
         assert 'timestamp' in result
         assert result['payload']['filename'] == 'wf-1.jpg'
         assert result['payload']['detections'] == []
+
+    def test_redelivery_republishes_cached_event(self, tmp_path):
+        ch = MagicMock()
+        method = MagicMock()
+        body = json.dumps({
+            'eventId': 'e-fetched',
+            'workflowId': 'wf-1',
+            'payload': {'filename': 'wf-1.jpg'},
+        }).encode()
+
+        model = MagicMock()
+        model.names = {0: 'cat'}
+        result_obj = MagicMock()
+        result_obj.boxes = [_make_box(0, 0.9, [10, 20, 100, 200])]
+        model.return_value = [result_obj]
+
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+        dedup = DedupCache(max_entries=8)
+
+        first = handle_message(ch, method, body, driver, model, images_dir=str(tmp_path), dedup=dedup)
+        second = handle_message(ch, method, body, driver, model, images_dir=str(tmp_path), dedup=dedup)
+
+        assert second == first
+        assert model.call_count == 1
+        assert ch.basic_publish.call_count == 2
+        assert ch.basic_ack.call_count == 2
+        # Event and entities are recorded again (both MERGE) in case the first delivery crashed.
+        assert session.run.call_count == 6
+        assert [c[1]['eid'] for c in session.run.call_args_list if 'eid' in c[1]] == \
+            [first['eventId']] * 2
+
+    def test_near_duplicate_reuses_rescaled_detections(self, tmp_path):
+        image = Image.new('RGB', (200, 100), 'white')
+        image.paste('black', (0, 0, 100, 100))
+        image.save(tmp_path / 'wf-1.jpg')
+        image.resize((100, 50)).save(tmp_path / 'wf-2.jpg', quality=70)
+
+        ch = MagicMock()
+        method = MagicMock()
+        model = MagicMock()
+        model.names = {0: 'cat'}
+        result_obj = MagicMock()
+        result_obj.boxes = [_make_box(0, 0.9, [10, 20, 100, 80])]
+        model.return_value = [result_obj]
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+        near_dupes = NearDuplicateIndex(Image)
+
+        def body(wid):
+            return json.dumps({'eventId': f'e-{wid}', 'workflowId': wid,
+                               'payload': {'filename': f'{wid}.jpg'}}).encode()
+
+        first = handle_message(ch, method, body('wf-1'), driver, model, images_dir=str(tmp_path),
+                               near_dupes=near_dupes)
+        second = handle_message(ch, method, body('wf-2'), driver, model, images_dir=str(tmp_path),
+                                near_dupes=near_dupes)
+
+        assert model.call_count == 1
+        assert 'reusedFrom' not in first['payload']
+        assert second['payload']['reusedFrom']['workflowId'] == 'wf-1'
+        assert second['payload']['detections'] == [
+            {'label': 'cat', 'confidence': 0.9, 'bbox': [5.0, 10.0, 50.0, 40.0]},
+        ]
+
+    def test_cascade_stats_in_payload(self, tmp_path):
+        ch = MagicMock()
+        method = MagicMock()
+        body = json.dumps({'eventId': 'e-1', 'workflowId': 'wf-1',
+                           'payload': {'filename': 'wf-1.jpg'}}).encode()
+        model = _cascade_model([_make_box(0, 0.9, [0, 0, 300, 300])], [])
+        driver = MagicMock()
+
+        result = handle_message(ch, method, body, driver, model, images_dir=str(tmp_path),
+                                cascade=build_cascade_policy(320))
+
+        assert result['payload']['cascade']['tier'] == 'low'
+        assert len(result['payload']['detections']) == 1
+
+    def test_near_duplicate_with_other_aspect_ratio_is_not_reused(self, tmp_path):
+        # Flat images hash to 0 whatever their content or shape.
+        Image.new('RGB', (640, 480), 'white').save(tmp_path / 'wf-1.jpg')
+        Image.new('RGB', (480, 640), (20, 20, 20)).save(tmp_path / 'wf-2.jpg')
+        ch = MagicMock()
+        model = MagicMock()
+        model.names = {0: 'cat'}
+        result_obj = MagicMock()
+        result_obj.boxes = [_make_box(0, 0.9, [10, 20, 100, 80])]
+        model.return_value = [result_obj]
+        near_dupes = NearDuplicateIndex(Image)
+
+        for wid in ('wf-1', 'wf-2'):
+            body = json.dumps({'eventId': f'e-{wid}', 'workflowId': wid,
+                               'payload': {'filename': f'{wid}.jpg'}}).encode()
+            result = handle_message(ch, MagicMock(), body, MagicMock(), model, images_dir=str(tmp_path),
+                                    near_dupes=near_dupes)
+
+        assert near_dupes.lookup(0) is not None
+        assert model.call_count == 2
+        assert 'reusedFrom' not in result['payload']
+
+
+class TestRescaleDetections:
+    def test_scales_each_axis(self):
+        detections = [{'label': 'dog', 'confidence': 0.5, 'bbox': [10.0, 10.0, 20.0, 40.0]}]
+        assert rescale_detections(detections, (100, 200), (300, 100)) == [
+            {'label': 'dog', 'confidence': 0.5, 'bbox': [30.0, 5.0, 60.0, 20.0]},
+        ]
+
+
+class TestDescribeMessage:
+    def test_reports_size_and_detection_count(self, tmp_path):
+        (tmp_path / 'wf-1.jpg').write_bytes(b'x' * 10)
+        body = json.dumps({'payload': {'filename': 'wf-1.jpg'}}).encode()
+        result = {'payload': {'detections': [{}, {}]}}
+        assert describe_message(body, result, images_dir=str(tmp_path)) == \
+            {'imageBytes': 10, 'detections': 2, 'cascadeTier': None}
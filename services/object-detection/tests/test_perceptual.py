@@ -0,0 +1,80 @@
+import numpy as np
+from PIL import Image
+
+from perceptual import HashStore, NearDuplicateIndex, dhash
+
+
+def _gradient_image(path, size=(320, 240), flip=False):
+    x = np.linspace(0, 255, size[0])
+    y = np.linspace(0, 255, size[1])
+    pixels = (np.outer(np.sin(y / 40) + 1, np.cos(x / 30) + 1) * 60).astype(np.uint8)
+    if flip:
+        pixels = pixels[:, ::-1]
+    image = Image.fromarray(pixels).convert('RGB')
+    image.save(path, quality=95)
+    return image
+
+
+def _hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class TestDhash:
+    def test_resized_and_reencoded_copy_is_close(self, tmp_path):
+        original = _gradient_image(tmp_path / 'a.jpg')
+        original.resize((160, 120)).save(tmp_path / 'b.jpg', quality=60)
+        index = NearDuplicateIndex(Image)
+
+        (h1, size1), (h2, size2) = index.fingerprint(tmp_path / 'a.jpg'), index.fingerprint(tmp_path / 'b.jpg')
+        assert size1 == (320, 240) and size2 == (160, 120)
+        assert _hamming(h1, h2) <= 4
+
+    def test_different_image_is_far(self, tmp_path):
+        a = _gradient_image(tmp_path / 'a.jpg')
+        b = _gradient_image(tmp_path / 'b.jpg', flip=True)
+        assert _hamming(dhash(a), dhash(b)) > 10
+
+
+class TestNearDuplicateIndex:
+    def test_lookup_returns_closest_within_distance(self):
+        index = NearDuplicateIndex(Image, max_distance=3)
+        index.add(0b1111, {'workflowId': 'wf-a'})
+        index.add(0xFF00FF00FF00FF00, {'workflowId': 'wf-b'})
+
+        assert index.lookup(0b0111) == (1, {'workflowId': 'wf-a'})
+        assert index.lookup(0xFF00FF00FF00FF03) == (2, {'workflowId': 'wf-b'})
+        assert index.lookup(0xFFFF) is None
+
+    def test_accept_skips_to_next_closest(self):
+        index = NearDuplicateIndex(Image, max_distance=3)
+        index.add(0b0001, {'workflowId': 'wf-a', 'ok': False})
+        index.add(0b0111, {'workflowId': 'wf-b', 'ok': True})
+
+        assert index.lookup(0b0011, accept=lambda e: e['ok']) == (1, {'workflowId': 'wf-b', 'ok': True})
+        assert index.lookup(0b0011, accept=lambda e: False) is None
+
+    def test_empty_index(self):
+        assert NearDuplicateIndex(Image).lookup(0) is None
+
+    def test_ring_buffer_evicts_oldest(self):
+        index = NearDuplicateIndex(Image, max_distance=0, max_entries=2)
+        for i, h in enumerate([1, 2, 4]):
+            index.add(h, {'n': i})
+        assert len(index) == 2
+        assert index.lookup(1) is None
+        assert index.lookup(4) == (0, {'n': 2})
+
+    def test_rebuilds_from_store(self, tmp_path):
+        path = str(tmp_path / 'hashes.db')
+        top_bit = 1 << 63 | 5
+        index = NearDuplicateIndex(Image, store=HashStore(path))
+        index.add(top_bit, {'workflowId': 'wf-a'})
+
+        reloaded = NearDuplicateIndex(Image, store=HashStore(path))
+        assert reloaded.lookup(top_bit) == (0, {'workflowId': 'wf-a'})
+
+    def test_store_keeps_newest_rows(self, tmp_path):
+        store = HashStore(str(tmp_path / 'hashes.db'), max_rows=2)
+        for h in [1, 2, 3]:
+            store.put(h, {'h': h})
+        assert [h for h, _ in store.rows()] == [2, 3]
@@ -0,0 +1,174 @@
+import json
+import signal
+import threading
+import time
+import types
+import urllib.request
+
+from profiling import Profiler, install_signal_handlers, serve_http
+
+
+def _module():
+    module = types.SimpleNamespace()
+    module.work = lambda seconds: time.sleep(seconds)
+    return module
+
+
+def _callback(module):
+    def callback(ch, method, properties, body):
+        module.work(json.loads(body)['sleep'])
+        return {'ok': True}
+    return callback
+
+
+def _body(seconds):
+    return json.dumps({'sleep': seconds}).encode()
+
+
+class TestProfiler:
+    def test_disabled_is_pass_through(self):
+        module = _module()
+        original = module.work
+        profiler = Profiler(module, ['work'])
+        wrapped = profiler.wrap(_callback(module))
+
+        assert wrapped(None, None, None, _body(0)) == {'ok': True}
+        assert module.work is original
+        assert profiler.slowest_messages() == []
+
+    def test_enable_patches_and_disable_restores(self):
+        module = _module()
+        original = module.work
+        profiler = Profiler(module, ['work'])
+        profiler.enable()
+        assert module.work is not original
+        profiler.disable()
+        assert module.work is original
+
+    def test_records_stage_breakdown_and_input(self):
+        module = _module()
+        profiler = Profiler(module, ['work'], describe=lambda body, result: {'bytes': len(body)})
+        wrapped = profiler.wrap(_callback(module))
+        profiler.enable()
+        try:
+            wrapped(None, None, None, _body(0.02))
+        finally:
+            profiler.disable()
+
+        [entry] = profiler.slowest_messages()
+        assert entry['stagesMs']['work'] >= 15
+        assert 'other' in entry['stagesMs']
+        assert entry['input'] == {'bytes': len(_body(0.02))}
+
+    def test_nested_stages_record_self_time(self):
+        module = _module()
+        module.outer = lambda seconds: (time.sleep(0.02), module.work(seconds))
+        profiler = Profiler(module, ['outer', 'work'])
+
+        def callback(ch, method, properties, body):
+            module.outer(json.loads(body)['sleep'])
+
+        wrapped = profiler.wrap(callback)
+        profiler.enable()
+        try:
+            wrapped(None, None, None, _body(0.04))
+        finally:
+            profiler.disable()
+
+        [entry] = profiler.slowest_messages()
+        assert 15 <= entry['stagesMs']['outer'] < 35
+        assert entry['stagesMs']['work'] >= 35
+        assert entry['stagesMs']['other'] >= 0
+
+    def test_keeps_only_the_slowest(self):
+        module = _module()
+        profiler = Profiler(module, ['work'], slowest=2)
+        wrapped = profiler.wrap(_callback(module))
+        profiler.enable()
+        try:
+            for seconds in [0.0, 0.03, 0.0, 0.02]:
+                wrapped(None, None, None, _body(seconds))
+        finally:
+            profiler.disable()
+
+        durations = [e['durationMs'] for e in profiler.slowest_messages()]
+        assert len(durations) == 2
+        assert durations[0] >= durations[1] >= 15
+
+    def test_concurrent_calls_keep_their_own_stages(self):
+        module = _module()
+        profiler = Profiler(module, ['work'])
+        wrapped = profiler.wrap(_callback(module))
+        profiler.enable()
+        try:
+            threads = [threading.Thread(target=wrapped, args=(None, None, None, _body(s)))
+                       for s in [0.05, 0.0]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            profiler.disable()
+
+        slow, fast = profiler.slowest_messages()
+        assert slow['stagesMs']['work'] >= 40
+        assert fast['stagesMs']['work'] < 40
+
+    def test_samples_collapsed_stacks(self, tmp_path):
+        module = _module()
+        profiler = Profiler(module, ['work'], interval=0.001, out_dir=str(tmp_path))
+        wrapped = profiler.wrap(_callback(module))
+        profiler.enable()
+        try:
+            wrapped(None, None, None, _body(0.05))
+        finally:
+            profiler.disable()
+
+        stacks = profiler.collapsed_stacks()
+        assert 'test_profiling.py:callback' in stacks
+        stacks_path, slowest_path = profiler.dump()
+        assert open(stacks_path).read() == stacks
+        assert len(json.load(open(slowest_path))) == 1
+
+    def test_reenable_keeps_a_single_sampler(self):
+        module = _module()
+        profiler = Profiler(module, ['work'], interval=0.05)
+        profiler.enable()
+        profiler.disable()
+        profiler.enable()
+        try:
+            time.sleep(0.12)
+            samplers = [t for t in threading.enumerate() if getattr(t, '_target', None) == profiler._sample]
+            assert len(samplers) == 1
+        finally:
+            profiler.disable()
+
+    def test_signal_while_lock_held_does_not_deadlock(self):
+        profiler = Profiler(_module(), ['work'])
+        previous = signal.getsignal(signal.SIGUSR1), signal.getsignal(signal.SIGUSR2)
+        install_signal_handlers(profiler)
+        try:
+            with profiler.lock:
+                # As if the signal landed while _record held the lock on this thread.
+                signal.getsignal(signal.SIGUSR1)(signal.SIGUSR1, None)
+            deadline = time.time() + 2
+            while not profiler.enabled and time.time() < deadline:
+                time.sleep(0.01)
+            assert profiler.enabled
+        finally:
+            profiler.disable()
+            signal.signal(signal.SIGUSR1, previous[0])
+            signal.signal(signal.SIGUSR2, previous[1])
+
+    def test_http_toggle(self):
+        profiler = Profiler(_module(), ['work'])
+        server = serve_http(profiler, 0)
+        base = f'http://127.0.0.1:{server.server_address[1]}'
+        try:
+            urllib.request.urlopen(urllib.request.Request(f'{base}/profiling/enable', method='POST'))
+            status = json.load(urllib.request.urlopen(f'{base}/profiling'))
+            assert status['enabled'] is True
+            urllib.request.urlopen(urllib.request.Request(f'{base}/profiling/disable', method='POST'))
+            assert profiler.enabled is False
+        finally:
+            server.shutdown()
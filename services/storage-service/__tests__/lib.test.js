@@ -25,6 +25,7 @@ describe('handleMessage', () => {
     const minioPresignClient = { presignedGetObject: jest.fn().mockResolvedValue('http://presigned-url') };
     const msg = {
       content: Buffer.from(JSON.stringify({
+        eventId: 'e-0',
         workflowId: 'wf-1',
         payload: { filename: 'wf-1_annotated.jpg' },
       })),
@@ -44,6 +45,17 @@ describe('handleMessage', () => {
     expect(channel.publish).toHaveBeenCalled();
   });
 
+  it('links image.stored to the triggering event by id', async () => {
+    const { channel, driver, minioClient, minioPresignClient, msg, session } = setup();
+    const result = await handleMessage({ channel, driver, minioClient, minioPresignClient, imagesDir: '/data/images' }, msg);
+    expect(result.causationId).toBe('e-0');
+    expect(result.correlationId).toBe('wf-1');
+    expect(session.run).toHaveBeenLastCalledWith(
+      expect.stringContaining('MERGE (prev)-[:TRIGGERS]->(cur)'),
+      { prev: 'e-0', cur: 'test-uuid' }
+    );
+  });
+
   it('generates presigned URL with 7-day expiry', async () => {
     const { channel, driver, minioClient, minioPresignClient, msg } = setup();
     await handleMessage({ channel, driver, minioClient, minioPresignClient, imagesDir: '/data/images' }, msg);
@@ -58,7 +70,7 @@ describe('recordEvent', () => {
     const session = { run: jest.fn().mockResolvedValue(), close: jest.fn().mockResolvedValue() };
     const driver = { session: () => session };
     const event = { workflowId: 'wf-1', eventId: 'e-1', eventType: 'image.stored', timestamp: 't' };
-    await recordEvent(driver, event, 'image.annotated');
+    await recordEvent(driver, event, 'e-0');
     expect(session.run).toHaveBeenCalledTimes(2);
   });
 });
@@ -1,10 +1,48 @@
+const crypto = require('crypto');
+const fs = require('fs');
 const path = require('path');
 const { v4: uuidv4 } = require('uuid');
 
 const EXCHANGE = 'imageanalyzer.events';
 const BUCKET = 'images';
 
-async function recordEvent(driver, event, prevEventType) {
+function newSpanId() {
+  return crypto.randomBytes(8).toString('hex');
+}
+
+function exportSpan(span) {
+  if (!process.env.TRACE_FILE) return;
+  const record = { ...span, durationMs: span.end - span.start };
+  fs.appendFileSync(process.env.TRACE_FILE, JSON.stringify(record) + '\n');
+}
+
+function startTrace(service, msg, event) {
+  const headers = (msg.properties && msg.properties.headers) || {};
+  const match = /^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$/.exec(headers.traceparent || '');
+  const traceId = match ? match[1] : event.workflowId.replace(/-/g, '');
+  let parentId = match ? match[2] : null;
+  const start = Date.now();
+  const attributes = { workflowId: event.workflowId, eventType: event.eventType };
+  if (headers['x-published-at'] !== undefined) {
+    const spanId = newSpanId();
+    exportSpan({
+      traceId, spanId, parentId, service, name: 'queue',
+      start: Number(headers['x-published-at']), end: start, attributes,
+    });
+    parentId = spanId;
+  }
+  return { traceId, spanId: newSpanId(), parentId, service, name: 'handle', start, attributes };
+}
+
+function traceHeaders(trace) {
+  return { traceparent: `00-${trace.traceId}-${trace.spanId}-01`, 'x-published-at': Date.now() };
+}
+
+function endTrace(trace) {
+  exportSpan({ ...trace, end: Date.now() });
+}
+
+async function recordEvent(driver, event, prevEventId) {
   const session = driver.session();
   try {
     await session.run(
@@ -13,12 +51,11 @@ async function recordEvent(driver, event, prevEventType) {
        CREATE (e)-[:BELONGS_TO]->(w)`,
       { wid: event.workflowId, eid: event.eventId, type: event.eventType, ts: event.timestamp }
     );
-    if (prevEventType) {
+    if (prevEventId) {
       await session.run(
-        `MATCH (w:Workflow {id: $wid})<-[:BELONGS_TO]-(prev:Event {type: $prevType})
-         MATCH (cur:Event {id: $curId})
-         CREATE (prev)-[:TRIGGERS]->(cur)`,
-        { wid: event.workflowId, prevType: prevEventType, curId: event.eventId }
+        `MATCH (prev:Event {id: $prev}), (cur:Event {id: $cur})
+         MERGE (prev)-[:TRIGGERS]->(cur)`,
+        { prev: prevEventId, cur: event.eventId }
       );
     }
   } finally {
@@ -39,20 +76,27 @@ async function handleMessage({ channel, driver, minioClient, minioPresignClient,
   const { filename } = payload;
   const filepath = path.join(imagesDir, filename);
   const objectKey = `annotated/${filename}`;
+  const trace = startTrace('storage-service', msg, event);
 
-  await minioClient.fPutObject(BUCKET, objectKey, filepath);
-  const presignedUrl = await minioPresignClient.presignedGetObject(BUCKET, objectKey, 7 * 24 * 60 * 60);
+  try {
+    await minioClient.fPutObject(BUCKET, objectKey, filepath);
+    const presignedUrl = await minioPresignClient.presignedGetObject(BUCKET, objectKey, 7 * 24 * 60 * 60);
 
-  const outEvent = {
-    eventId: uuidv4(),
-    eventType: 'image.stored',
-    workflowId,
-    timestamp: new Date().toISOString(),
-    payload: { bucket: BUCKET, objectKey, presignedUrl },
-  };
-  channel.publish(EXCHANGE, 'image.stored', Buffer.from(JSON.stringify(outEvent)));
-  await recordEvent(driver, outEvent, 'image.annotated');
-  return outEvent;
+    const outEvent = {
+      eventId: uuidv4(),
+      eventType: 'image.stored',
+      workflowId,
+      causationId: event.eventId || null,
+      correlationId: event.correlationId || workflowId,
+      timestamp: new Date().toISOString(),
+      payload: { bucket: BUCKET, objectKey, presignedUrl },
+    };
+    channel.publish(EXCHANGE, 'image.stored', Buffer.from(JSON.stringify(outEvent)), { headers: traceHeaders(trace) });
+    await recordEvent(driver, outEvent, outEvent.causationId);
+    return outEvent;
+  } finally {
+    endTrace(trace);
+  }
 }
 
-module.exports = { EXCHANGE, BUCKET, recordEvent, ensureBucket, handleMessage };
+module.exports = { EXCHANGE, BUCKET, recordEvent, ensureBucket, handleMessage, startTrace, traceHeaders };
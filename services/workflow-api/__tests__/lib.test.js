@@ -1,4 +1,4 @@
-const { publish, recordEvent, validateImageUrl, handleCreateWorkflow, handleGetWorkflow } = require('../lib');
+const { publish, recordEvent, ensureSchema, validateImageUrl, handleCreateWorkflow, handleGetWorkflow } = require('../lib');
 
 jest.mock('uuid', () => ({ v4: () => 'test-uuid' }));
 
@@ -12,10 +12,13 @@ describe('publish', () => {
     expect(event.workflowId).toBe('wf-1');
     expect(event.payload).toEqual({ imageUrl: 'http://x.com/img.jpg' });
     expect(event.timestamp).toBeDefined();
+    expect(event.causationId).toBeNull();
+    expect(event.correlationId).toBe('wf-1');
     expect(channel.publish).toHaveBeenCalledWith(
       'imageanalyzer.events',
       'workflow.started',
-      expect.any(Buffer)
+      expect.any(Buffer),
+      { headers: { traceparent: expect.stringMatching(/^00-wf1-[0-9a-f]{16}-01$/), 'x-published-at': expect.any(Number) } }
     );
   });
 });
@@ -44,6 +47,17 @@ describe('recordEvent', () => {
   });
 });
 
+describe('ensureSchema', () => {
+  it('creates a uniqueness constraint on Event ids', async () => {
+    const session = { run: jest.fn().mockResolvedValue(), close: jest.fn().mockResolvedValue() };
+    const driver = { session: () => session };
+    await ensureSchema(driver);
+
+    expect(session.run).toHaveBeenCalledWith(expect.stringContaining('REQUIRE e.id IS UNIQUE'));
+    expect(session.close).toHaveBeenCalled();
+  });
+});
+
 describe('validateImageUrl', () => {
   it('succeeds when HEAD returns image content-type', async () => {
     const axios = { head: jest.fn().mockResolvedValue({ headers: { 'content-type': 'image/jpeg' } }) };
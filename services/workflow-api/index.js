@@ -2,7 +2,7 @@ const fastify = require('fastify')({ logger: true });
 const amqp = require('amqplib');
 const neo4j = require('neo4j-driver');
 const axios = require('axios');
-const { handleCreateWorkflow, handleGetWorkflow } = require('./lib');
+const { ensureSchema, handleCreateWorkflow, handleGetWorkflow } = require('./lib');
 
 let channel;
 const driver = neo4j.driver(
@@ -21,6 +21,7 @@ fastify.get('/workflows/:id', (req, reply) => handleGetWorkflow(req, reply, { dr
 fastify.get('/health', async () => ({ status: 'ok' }));
 
 async function start() {
+  await ensureSchema(driver);
   await setupRabbit();
   await fastify.listen({ port: 3000, host: '0.0.0.0' });
 }
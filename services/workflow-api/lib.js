@@ -1,16 +1,24 @@
+const crypto = require('crypto');
 const { v4: uuidv4 } = require('uuid');
 
 const EXCHANGE = 'imageanalyzer.events';
 
-function publish(channel, eventType, workflowId, payload) {
+function publish(channel, eventType, workflowId, payload, causationId = null) {
   const event = {
     eventId: uuidv4(),
     eventType,
     workflowId,
+    causationId,
+    correlationId: workflowId,
     timestamp: new Date().toISOString(),
     payload,
   };
-  channel.publish(EXCHANGE, eventType, Buffer.from(JSON.stringify(event)));
+  // Each workflow is one trace; downstream services continue it from these headers.
+  const headers = {
+    traceparent: `00-${workflowId.replace(/-/g, '')}-${crypto.randomBytes(8).toString('hex')}-01`,
+    'x-published-at': Date.now(),
+  };
+  channel.publish(EXCHANGE, eventType, Buffer.from(JSON.stringify(event)), { headers });
   return event;
 }
 
@@ -26,7 +34,7 @@ async function recordEvent(driver, event, prevEventId) {
     if (prevEventId) {
       await session.run(
         `MATCH (prev:Event {id: $prev}), (cur:Event {id: $cur})
-         CREATE (prev)-[:TRIGGERS]->(cur)`,
+         MERGE (prev)-[:TRIGGERS]->(cur)`,
         { prev: prevEventId, cur: event.eventId }
       );
     }
@@ -35,6 +43,15 @@ async function recordEvent(driver, event, prevEventId) {
   }
 }
 
+async function ensureSchema(driver) {
+  const session = driver.session();
+  try {
+    await session.run('CREATE CONSTRAINT event_id IF NOT EXISTS FOR (e:Event) REQUIRE e.id IS UNIQUE');
+  } finally {
+    await session.close();
+  }
+}
+
 const USER_AGENT = 'ImageAnalyzer/1.0';
 
 async function validateImageUrl(axios, imageUrl) {
@@ -108,4 +125,4 @@ async function handleGetWorkflow(req, reply, { driver }) {
   }
 }
 
-module.exports = { EXCHANGE, publish, recordEvent, validateImageUrl, handleCreateWorkflow, handleGetWorkflow };
+module.exports = { EXCHANGE, publish, recordEvent, ensureSchema, validateImageUrl, handleCreateWorkflow, handleGetWorkflow };
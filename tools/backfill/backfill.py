@@ -0,0 +1,281 @@
+"""Reprocess a directory of images through the Python stages without RabbitMQ.
+
+    python tools/backfill/backfill.py /data/archive --out results.jsonl --workers 8
+
+Runs extract_metadata, batched detect_objects and annotate in a process pool,
+streams one record per image to JSONL or Parquet and can bulk-load the results
+into Neo4j. Finished images are appended to a checkpoint file so an interrupted
+run resumes where it stopped.
+"""
+import argparse
+import hashlib
+import importlib.util
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SERVICES_DIR = os.path.join(ROOT, 'services')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+NEO4J_BATCH_SIZE = 500
+
+_worker = {}
+
+
+def load_logic(service):
+    # Every service ships its own logic.py, so load each one under a distinct module name.
+    path = os.path.join(SERVICES_DIR, service, 'logic.py')
+    spec = importlib.util.spec_from_file_location(f"{service.replace('-', '_')}_logic", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def image_id(relpath):
+    return 'backfill-' + hashlib.sha1(relpath.encode()).hexdigest()[:16]
+
+
+def iter_images(source_dir, manifest=None):
+    if manifest:
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                yield json.loads(line)['path'] if line.startswith('{') else line
+        return
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.relpath(os.path.join(dirpath, name), source_dir)
+
+
+def chunked(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def append_checkpoint(path, ids):
+    with open(path, 'a') as f:
+        f.writelines(f'{i}\n' for i in ids)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def init_worker(model_path):
+    import exifread
+    from PIL import Image
+    from ultralytics import YOLO
+
+    _worker.update(
+        metadata=load_logic('metadata-extractor'),
+        detection=load_logic('object-detection'),
+        annotator=load_logic('image-annotator'),
+        exifread=exifread,
+        image_class=Image,
+        model=YOLO(model_path),
+    )
+
+
+# What a missing or undecodable image raises (PIL's UnidentifiedImageError is an OSError).
+# Anything else is a bug or an API mismatch and must not quietly turn batching off.
+READ_ERRORS = (OSError, ValueError)
+
+
+def detect_batch(filepaths):
+    detection, model = _worker['detection'], _worker['model']
+    try:
+        results = detection.detect_objects_batch(filepaths, model)
+        if len(results) == len(filepaths):
+            return results
+        # Ultralytics skips images it cannot read, so the results no longer line up.
+        print(f'Batch returned {len(results)} results for {len(filepaths)} images, retrying one by one')
+    except READ_ERRORS as err:
+        # One unreadable file fails the whole batch; retry one by one to isolate it.
+        print(f'Batch failed ({err!r}), retrying one by one')
+    results = []
+    for filepath in filepaths:
+        try:
+            results.append(detection.detect_objects(filepath, model))
+        except READ_ERRORS as err:
+            print(f'Detection failed for {filepath}: {err!r}')
+            results.append(None)
+    return results
+
+
+def process_batch(relpaths, source_dir, annotated_dir):
+    filepaths = [os.path.join(source_dir, p) for p in relpaths]
+    all_detections = detect_batch(filepaths)
+    records = []
+    for relpath, filepath, detections in zip(relpaths, filepaths, all_detections):
+        wid = image_id(relpath)
+        exif = _worker['metadata'].extract_metadata(filepath, _worker['exifread'], _worker['image_class'])
+        annotated = None
+        if annotated_dir and detections is not None:
+            annotated = _worker['annotator'].annotate(wid, {'exif': exif}, detections, relpath,
+                                                      images_dir=source_dir, out_dir=annotated_dir)
+        records.append({
+            'imageId': wid,
+            'path': relpath,
+            'metadata': {'exif': exif},
+            'detections': detections or [],
+            'annotated': annotated,
+            'error': 'detection failed' if detections is None else None,
+        })
+    return records
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def write(self, records):
+        for record in records:
+            self.f.write(json.dumps(record, default=str) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter:
+    # One part file per batch: Parquet files cannot be appended to, and this keeps resume simple.
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.dir = path
+        os.makedirs(path, exist_ok=True)
+        self.part = len([n for n in os.listdir(path) if n.endswith('.parquet')])
+
+    def write(self, records):
+        rows = [{
+            'imageId': r['imageId'],
+            'path': r['path'],
+            'metadata': json.dumps(r['metadata'], default=str),
+            'detections': json.dumps(r['detections']),
+            'annotated': r['annotated'],
+            'error': r['error'],
+        } for r in records]
+        self.pq.write_table(self.pa.Table.from_pylist(rows),
+                            os.path.join(self.dir, f'part-{self.part:05d}.parquet'))
+        self.part += 1
+
+    def close(self):
+        pass
+
+
+def open_writer(path, fmt=None):
+    fmt = fmt or ('parquet' if path.endswith('.parquet') else 'jsonl')
+    return ParquetWriter(path) if fmt == 'parquet' else JsonlWriter(path)
+
+
+def load_neo4j(neo4j_driver, records):
+    rows = [{'workflowId': r['imageId'], 'path': r['path'], 'detections': r['detections']}
+            for r in records]
+    with neo4j_driver.session() as session:
+        for batch in chunked(rows, NEO4J_BATCH_SIZE):
+            session.run(
+                "UNWIND $rows AS row "
+                "MERGE (w:Workflow {id: row.workflowId}) "
+                "SET w.source = 'backfill', w.path = row.path "
+                "WITH w, row "
+                "UNWIND row.detections AS det "
+                "MERGE (e:Entity {label: det.label}) "
+                "MERGE (w)-[d:DETECTED {bbox: det.bbox}]->(e) "
+                "SET d.confidence = det.confidence",
+                rows=batch
+            )
+
+
+def backfill(executor, batches, source_dir, annotated_dir, writer, checkpoint, neo4j_driver=None,
+             max_in_flight=4):
+    done = 0
+    pending = set()
+    batches = iter(batches)
+    while True:
+        # Bounded submission keeps a million-image backfill from queueing every batch up front.
+        for batch in batches:
+            pending.add(executor.submit(process_batch, batch, source_dir, annotated_dir))
+            if len(pending) >= max_in_flight:
+                break
+        if not pending:
+            return done
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            records = future.result()
+            writer.write(records)
+            if neo4j_driver is not None:
+                load_neo4j(neo4j_driver, records)
+            append_checkpoint(checkpoint, [r['imageId'] for r in records])
+            done += len(records)
+        print(f'Backfilled {done} images')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('source', help='directory the image paths are relative to')
+    parser.add_argument('--manifest', help='file with one relative path (or {"path": ...} JSON) per line')
+    parser.add_argument('--out', required=True, help='results file (.jsonl) or directory (.parquet)')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'])
+    parser.add_argument('--annotated-dir', help='where annotated images go (default: next to --out)')
+    parser.add_argument('--no-annotate', action='store_true')
+    parser.add_argument('--checkpoint', help='default: <out>.checkpoint')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--model', default='yolov8n.pt')
+    parser.add_argument('--neo4j', action='store_true', help='bulk-load results using NEO4J_* env vars')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    checkpoint = args.checkpoint or args.out.rstrip('/') + '.checkpoint'
+    annotated_dir = None
+    if not args.no_annotate:
+        annotated_dir = args.annotated_dir or os.path.join(os.path.dirname(os.path.abspath(args.out)), 'annotated')
+        os.makedirs(annotated_dir, exist_ok=True)
+
+    finished = load_checkpoint(checkpoint)
+    todo = (p for p in iter_images(args.source, args.manifest) if image_id(p) not in finished)
+    if finished:
+        print(f'Resuming: skipping {len(finished)} already processed images')
+
+    neo4j_driver = None
+    if args.neo4j:
+        from neo4j import GraphDatabase
+        neo4j_driver = GraphDatabase.driver(
+            os.environ['NEO4J_URI'],
+            auth=(os.environ['NEO4J_USER'], os.environ['NEO4J_PASSWORD'])
+        )
+
+    writer = open_writer(args.out, args.format)
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(args.model,)) as executor:
+            backfill(executor, chunked(todo, args.batch_size), args.source, annotated_dir, writer,
+                     checkpoint, neo4j_driver, max_in_flight=args.workers * 2)
+    finally:
+        writer.close()
+        if neo4j_driver is not None:
+            neo4j_driver.close()
+
+
+if __name__ == '__main__':
+    main()
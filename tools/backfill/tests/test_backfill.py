@@ -0,0 +1,166 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, call
+
+import pytest
+
+from PIL import Image
+
+import backfill
+from backfill import (
+    image_id, iter_images, chunked, load_checkpoint, append_checkpoint, process_batch,
+    load_neo4j, open_writer, JsonlWriter, load_logic,
+)
+
+
+def _create_test_image(path, size=(64, 48)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    Image.new('RGB', size, color='blue').save(str(path), 'JPEG')
+
+
+def _box(bbox):
+    box = MagicMock()
+    box.cls = [0]
+    box.conf = [0.9]
+    box.xyxy = [MagicMock()]
+    box.xyxy[0].tolist.return_value = bbox
+    return box
+
+
+def _fake_worker(fail_batch=False, batch_error=None):
+    model = MagicMock()
+    model.names = {0: 'cat'}
+
+    def predict(source, verbose=False, batch=1):
+        if isinstance(source, list):
+            if batch_error is not None:
+                raise batch_error
+            if fail_batch:
+                raise ValueError('bad image in batch')
+            return [MagicMock(boxes=[_box([1, 2, 10, 20])]) for _ in source]
+        if source.endswith('broken.jpg'):
+            raise ValueError('bad image')
+        return [MagicMock(boxes=[_box([1, 2, 10, 20])])]
+
+    model.side_effect = predict
+    exifread_mod = MagicMock()
+    exifread_mod.process_file.return_value = {}
+    backfill._worker.update(
+        metadata=load_logic('metadata-extractor'),
+        detection=load_logic('object-detection'),
+        annotator=load_logic('image-annotator'),
+        exifread=exifread_mod,
+        image_class=Image,
+        model=model,
+    )
+    return model
+
+
+class TestIterImages:
+    def test_walks_directory_in_order(self, tmp_path):
+        _create_test_image(tmp_path / 'b' / 'two.jpg')
+        _create_test_image(tmp_path / 'a.jpg')
+        (tmp_path / 'notes.txt').write_text('skip me')
+        assert list(iter_images(str(tmp_path))) == ['a.jpg', 'b/two.jpg']
+
+    def test_reads_manifest(self, tmp_path):
+        manifest = tmp_path / 'manifest.txt'
+        manifest.write_text('# comment\nx.jpg\n{"path": "y/z.jpg"}\n\n')
+        assert list(iter_images(str(tmp_path), str(manifest))) == ['x.jpg', 'y/z.jpg']
+
+
+class TestHelpers:
+    def test_image_id_is_stable(self):
+        assert image_id('a/b.jpg') == image_id('a/b.jpg')
+        assert image_id('a/b.jpg') != image_id('a/c.jpg')
+
+    def test_chunked(self):
+        assert list(chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+    def test_checkpoint_roundtrip(self, tmp_path):
+        path = str(tmp_path / 'ckpt')
+        assert load_checkpoint(path) == set()
+        append_checkpoint(path, ['a', 'b'])
+        append_checkpoint(path, ['c'])
+        assert load_checkpoint(path) == {'a', 'b', 'c'}
+
+
+class TestProcessBatch:
+    def test_runs_all_stages(self, tmp_path):
+        _create_test_image(tmp_path / 'src' / 'a.jpg')
+        out = tmp_path / 'annotated'
+        out.mkdir()
+        model = _fake_worker()
+
+        records = process_batch(['a.jpg'], str(tmp_path / 'src'), str(out))
+        assert model.call_args_list == [call([str(tmp_path / 'src' / 'a.jpg')], batch=1, verbose=False)]
+        assert len(records) == 1
+        record = records[0]
+        assert record['imageId'] == image_id('a.jpg')
+        assert record['metadata']['exif']['ImageWidth'] == 64
+        assert record['detections'][0]['label'] == 'cat'
+        assert (out / record['annotated']).exists()
+
+    def test_isolates_unreadable_image(self, tmp_path):
+        _create_test_image(tmp_path / 'a.jpg')
+        (tmp_path / 'broken.jpg').write_bytes(b'nope')
+        model = _fake_worker(fail_batch=True)
+
+        records = process_batch(['a.jpg', 'broken.jpg'], str(tmp_path), None)
+        assert records[0]['error'] is None
+        assert records[0]['annotated'] is None
+        assert records[1]['error'] == 'detection failed'
+        assert model.call_count == 3  # failed batch + one retry per image
+
+    def test_unexpected_batch_error_is_not_swallowed(self, tmp_path):
+        _create_test_image(tmp_path / 'a.jpg')
+        _fake_worker(batch_error=TypeError("unexpected keyword argument 'batch'"))
+
+        with pytest.raises(TypeError):
+            process_batch(['a.jpg'], str(tmp_path), None)
+
+
+class TestBackfill:
+    def test_writes_results_and_resumes(self, tmp_path):
+        src = tmp_path / 'src'
+        for name in ['a.jpg', 'b.jpg', 'c.jpg']:
+            _create_test_image(src / name)
+        _fake_worker()
+        out = tmp_path / 'results.jsonl'
+        ckpt = str(tmp_path / 'results.ckpt')
+
+        append_checkpoint(ckpt, [image_id('a.jpg')])
+        finished = load_checkpoint(ckpt)
+        todo = [p for p in iter_images(str(src)) if image_id(p) not in finished]
+
+        writer = JsonlWriter(str(out))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            done = backfill.backfill(executor, chunked(todo, 1), str(src), None, writer, ckpt,
+                                     max_in_flight=1)
+        writer.close()
+
+        assert done == 2
+        lines = [json.loads(line) for line in out.read_text().splitlines()]
+        assert sorted(r['path'] for r in lines) == ['b.jpg', 'c.jpg']
+        assert load_checkpoint(ckpt) == {image_id(p) for p in ['a.jpg', 'b.jpg', 'c.jpg']}
+
+    def test_writer_format_from_extension(self, tmp_path):
+        writer = open_writer(str(tmp_path / 'out.jsonl'))
+        assert isinstance(writer, JsonlWriter)
+        writer.close()
+
+
+class TestLoadNeo4j:
+    def test_unwinds_in_batches(self, monkeypatch):
+        monkeypatch.setattr(backfill, 'NEO4J_BATCH_SIZE', 2)
+        session = MagicMock()
+        driver = MagicMock()
+        driver.session.return_value.__enter__ = MagicMock(return_value=session)
+        driver.session.return_value.__exit__ = MagicMock(return_value=False)
+
+        records = [{'imageId': f'i-{n}', 'path': f'{n}.jpg', 'detections': []} for n in range(5)]
+        load_neo4j(driver, records)
+
+        assert session.run.call_count == 3
+        assert 'UNWIND $rows AS row' in session.run.call_args[0][0]
+        assert len(session.run.call_args[1]['rows']) == 1
@@ -0,0 +1,89 @@
+"""Reconstruct each workflow's critical path from exported spans.
+
+    python tools/trace/critical_path.py data/images/spans.jsonl
+
+Spans are written by the services when TRACE_FILE is set. For every trace the
+last span to finish is followed back through its parents; that chain is the
+critical path (for the annotator join it runs through whichever of metadata and
+detection arrived last). Each hop is split into queue wait and processing time,
+and the summary shows which stage contributes most across workflows.
+"""
+import argparse
+import json
+from collections import defaultdict
+
+
+def load_spans(paths):
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    span = json.loads(line)
+                    traces[span['traceId']].append(span)
+    return traces
+
+
+def critical_path(spans):
+    by_id = {span['spanId']: span for span in spans}
+    handles = [span for span in spans if span['name'] == 'handle']
+    if not handles:
+        return []
+    chain = []
+    span = max(handles, key=lambda s: s['end'])
+    while span is not None:
+        chain.append(span)
+        span = by_id.get(span['parentId'])
+    chain.reverse()
+
+    hops = []
+    for span in chain:
+        if span['name'] == 'queue' or not hops or hops[-1]['workMs'] is not None:
+            hops.append({'service': span['service'], 'queueMs': 0.0, 'workMs': None})
+        key = 'queueMs' if span['name'] == 'queue' else 'workMs'
+        hops[-1][key] = round(span['end'] - span['start'], 3)
+    for hop in hops:
+        hop['workMs'] = hop['workMs'] or 0.0
+    return hops
+
+
+def summarize(paths_by_trace):
+    totals = defaultdict(lambda: {'queueMs': 0.0, 'workMs': 0.0, 'count': 0})
+    for hops in paths_by_trace.values():
+        for hop in hops:
+            stage = totals[hop['service']]
+            stage['queueMs'] += hop['queueMs']
+            stage['workMs'] += hop['workMs']
+            stage['count'] += 1
+    overall = sum(s['queueMs'] + s['workMs'] for s in totals.values()) or 1.0
+    return {
+        service: {
+            'avgQueueMs': round(s['queueMs'] / s['count'], 3),
+            'avgWorkMs': round(s['workMs'] / s['count'], 3),
+            'share': round((s['queueMs'] + s['workMs']) / overall, 3),
+        }
+        for service, s in sorted(totals.items(), key=lambda item: -(item[1]['queueMs'] + item[1]['workMs']))
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('spans', nargs='+', help='span JSONL files')
+    parser.add_argument('--workflows', action='store_true', help='print the path of every workflow')
+    args = parser.parse_args(argv)
+
+    paths = {trace_id: critical_path(spans) for trace_id, spans in load_spans(args.spans).items()}
+    paths = {trace_id: hops for trace_id, hops in paths.items() if hops}
+    if args.workflows:
+        for trace_id, hops in paths.items():
+            total = sum(h['queueMs'] + h['workMs'] for h in hops)
+            steps = ' -> '.join(f"{h['service']} (q {h['queueMs']:.0f} / w {h['workMs']:.0f})" for h in hops)
+            print(f'{trace_id} {total:.0f}ms: {steps}')
+    print(f'{"stage":<20} {"avg queue ms":>12} {"avg work ms":>12} {"share":>7}')
+    for service, stats in summarize(paths).items():
+        print(f'{service:<20} {stats["avgQueueMs"]:>12.1f} {stats["avgWorkMs"]:>12.1f} {stats["share"]:>7.1%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import json
+
+from critical_path import critical_path, load_spans, main, summarize
+
+
+def _span(span_id, parent_id, service, name, start, end, trace_id='t1'):
+    return {'traceId': trace_id, 'spanId': span_id, 'parentId': parent_id, 'service': service,
+            'name': name, 'start': start, 'end': end}
+
+
+def _workflow(trace_id='t1'):
+    # fetch, then metadata (fast) and detection (slow) in parallel, then annotation and storage.
+    return [
+        _span('fq', 'root', 'image-fetcher', 'queue', 0, 5, trace_id),
+        _span('fh', 'fq', 'image-fetcher', 'handle', 5, 105, trace_id),
+        _span('mq', 'fh', 'metadata-extractor', 'queue', 100, 110, trace_id),
+        _span('mh', 'mq', 'metadata-extractor', 'handle', 110, 130, trace_id),
+        _span('dq', 'fh', 'object-detection', 'queue', 100, 150, trace_id),
+        _span('dh', 'dq', 'object-detection', 'handle', 150, 450, trace_id),
+        _span('aq1', 'mh', 'image-annotator', 'queue', 128, 131, trace_id),
+        _span('ah1', 'aq1', 'image-annotator', 'handle', 131, 132, trace_id),
+        _span('aq2', 'dh', 'image-annotator', 'queue', 448, 452, trace_id),
+        _span('ah2', 'aq2', 'image-annotator', 'handle', 452, 500, trace_id),
+        _span('sq', 'ah2', 'storage-service', 'queue', 498, 510, trace_id),
+        _span('sh', 'sq', 'storage-service', 'handle', 510, 600, trace_id),
+    ]
+
+
+class TestCriticalPath:
+    def test_follows_the_slower_branch(self):
+        hops = critical_path(_workflow())
+        assert [h['service'] for h in hops] == [
+            'image-fetcher', 'object-detection', 'image-annotator', 'storage-service',
+        ]
+        assert hops[1] == {'service': 'object-detection', 'queueMs': 50, 'workMs': 300}
+
+    def test_handle_without_queue_span(self):
+        hops = critical_path([_span('h', None, 'image-fetcher', 'handle', 0, 10)])
+        assert hops == [{'service': 'image-fetcher', 'queueMs': 0.0, 'workMs': 10}]
+
+    def test_no_handle_spans(self):
+        assert critical_path([_span('q', None, 'image-fetcher', 'queue', 0, 10)]) == []
+
+
+class TestSummarize:
+    def test_ranks_stages_by_share(self):
+        summary = summarize({'t1': critical_path(_workflow('t1')), 't2': critical_path(_workflow('t2'))})
+        assert list(summary)[0] == 'object-detection'
+        assert summary['object-detection']['avgWorkMs'] == 300
+        assert round(sum(s['share'] for s in summary.values()), 2) == 1.0
+
+
+class TestMain:
+    def test_reads_span_files(self, tmp_path, capsys):
+        path = tmp_path / 'spans.jsonl'
+        path.write_text(''.join(json.dumps(s) + '\n' for s in _workflow()))
+        assert list(load_spans([str(path)])) == ['t1']
+
+        main([str(path), '--workflows'])
+        out = capsys.readouterr().out
+        assert 't1 609ms' in out
+        assert 'object-detection' in out